@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""Benchmarks for wyag, on synthetic repositories built with git in a
+temporary directory.
+
+    python bench/bench.py                    # every benchmark
+    python bench/bench.py checkout           # only some of them
+    python bench/bench.py --scale 10         # bigger repositories
+    python bench/bench.py --record bench/history.jsonl
+
+With --record, every measurement is also appended to a file as a JSON
+line, along with the commit of the tree and the date, so that runs can
+be compared over time."""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import libwyag
+
+# name -> function(tmp, scale), yielding (metric, value, unit)
+BENCHMARKS = dict()
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__.removeprefix("bench_").replace("_", "-")] = fn
+    return fn
+
+def git(cwd, *args, input=None):
+    return subprocess.run(["git", *args], cwd=cwd, input=input, check=True,
+                          capture_output=True).stdout
+
+def fast_import(path, commits):
+    """Create a repository at path, with one commit per item of commits
+    on main: a dict of path -> content (bytes), or None to delete it."""
+    git(None, "init", "-q", "-b", "main", path)
+    stream = list()
+    for n, files in enumerate(commits):
+        stream.append(b"commit refs/heads/main\n"
+                      b"committer wyag <wyag@example.com> %d +0000\n"
+                      b"data 11\ncommit %04d\n" % (1600000000 + n, n % 10000))
+        for name, data in files.items():
+            if data is None:
+                stream.append(b"D %s\n" % name.encode())
+            else:
+                stream.append(b"M 100644 inline %s\ndata %d\n%s\n" % (name.encode(), len(data), data))
+        stream.append(b"\n")
+    git(path, "fast-import", "--quiet", input=b"".join(stream))
+    git(path, "reset", "-q", "--hard")
+
+def text(rng, size):
+    """size bytes of text-like data, which compresses like source code."""
+    words = [ b"self", b"return", b"def", b"if", b"else", b"for", b"in", b"=", b"(", b")",
+              b"repo", b"path", b"sha", b"data", b"None", b"0", b"1", b"+", b"#", b":" ]
+    out = list()
+    n = 0
+    while n < size:
+        line = b" ".join(rng.choices(words, k=rng.randint(1, 12))) + b"\n"
+        out.append(line)
+        n += len(line)
+    return b"".join(out)[:size]
+
+def timed(fn, repeat=1):
+    """Best wall time of fn over repeat runs, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@benchmark
+def bench_checkout(tmp, scale):
+    """tree_checkout of a tree of small files into an empty directory,
+    with 1, 2, 4 and 8 workers, from a pack and from loose objects."""
+    rng = random.Random(5)
+    files = int(2000 * scale)
+    path = os.path.join(tmp, "checkout")
+    fast_import(path, [ { f"d{i % 100}/f{i}.py": text(rng, 9000) for i in range(files) } ])
+    # Similar files: most of the pack ends up deltified.
+    git(path, "repack", "-adfq")
+
+    def run(jobs):
+        dest = os.path.join(tmp, "checkout-out")
+        shutil.rmtree(dest, ignore_errors=True)
+        os.mkdir(dest)
+        repo = libwyag.repo_find(path)
+        tree = libwyag.object_read(repo, libwyag.object_find(repo, "HEAD", fmt=b"tree"))
+        return timed(lambda: libwyag.tree_checkout(repo, tree, dest, jobs=jobs))
+
+    for storage in ("packed", "loose"):
+        if storage == "loose":
+            pack_dir = os.path.join(path, ".git", "objects", "pack")
+            for name in os.listdir(pack_dir):
+                if name.endswith(".pack"):
+                    with open(os.path.join(pack_dir, name), "rb") as f:
+                        data = f.read()
+                    for suffix in (".pack", ".idx"):
+                        os.remove(os.path.join(pack_dir, name[:-5] + suffix))
+                    git(path, "unpack-objects", "-q", input=data)
+        for jobs in (1, 2, 4, 8):
+            yield f"{files} files, {storage}, -j {jobs}", run(jobs), "s"
+
+
+@benchmark
+def bench_kvlm(tmp, scale):
+    """Parsing and serializing a commit with 40 parents and a 400-line
+    signature."""
+    n = int(2000 * scale)
+    signature = b"gpgsig -----BEGIN PGP SIGNATURE-----\n" \
+        + b"".join(b" " + b"A" * 64 + b"\n" for _ in range(400)) \
+        + b" -----END PGP SIGNATURE-----\n"
+    raw = b"tree " + b"a" * 40 + b"\n" \
+        + b"".join(b"parent %040x\n" % i for i in range(40)) \
+        + b"author A <a@example.com> 1 +0000\ncommitter A <a@example.com> 1 +0000\n" \
+        + signature + b"\n" + b"message\n" * 20
+
+    def per_call(fn):
+        return timed(lambda: [ fn() for _ in range(n) ], repeat=3) / n * 1e6
+
+    # Reading a list value (the parents) marks a GitKvlm as modified.
+    kvlm = libwyag.kvlm_parse(raw)
+    plain = dict(libwyag.kvlm_parse(raw).items())
+    yield "parse", per_call(lambda: libwyag.kvlm_parse(raw)), "us"
+    yield "parse, read tree and parents", \
+        per_call(lambda: (lambda k: (k[b"tree"], k[b"parent"]))(libwyag.kvlm_parse(raw))), "us"
+    yield "parse, read every value", per_call(lambda: dict(libwyag.kvlm_parse(raw).items())), "us"
+    yield "serialize unmodified", per_call(lambda: libwyag.kvlm_serialize(kvlm)), "us"
+    yield "serialize a dict", per_call(lambda: libwyag.kvlm_serialize(plain)), "us"
+
+
+@benchmark
+def bench_index(tmp, scale):
+    """index_write and index_read of a synthetic index of 200,000
+    entries."""
+    import hashlib
+    count = int(200000 * scale)
+    path = os.path.join(tmp, "index")
+    git(None, "init", "-q", path)
+    repo = libwyag.repo_find(path)
+    entries = [ libwyag.GitIndexEntry((1600000000, 0), (1600000000, 0), 1, i, 0b1000, 0o644, 0, 0, i,
+                                      hashlib.sha1(str(i).encode()).hexdigest(), False, 0,
+                                      f"dir{i // 1000}/sub{i % 7}/file{i}.c")
+                for i in range(count) ]
+    entries.sort(key=lambda e: e.name.encode("utf8"))
+    index = libwyag.GitIndex(2, entries)
+
+    yield f"write {count} entries", timed(lambda: libwyag.index_write(repo, index), repeat=3), "s"
+    yield f"read {count} entries", timed(lambda: libwyag.index_read(repo), repeat=3), "s"
+
+
+@benchmark
+def bench_add(tmp, scale):
+    """add of a whole worktree into an empty repository, then status
+    after every file was touched (so that all must be hashed), with 1,
+    2, 4 and 8 workers."""
+    import contextlib, io
+    rng = random.Random(14)
+    files = int(2000 * scale)
+    path = os.path.join(tmp, "add")
+    os.mkdir(path)
+    size = 0
+    for i in range(files):
+        os.makedirs(os.path.join(path, f"d{i % 50}"), exist_ok=True)
+        with open(os.path.join(path, f"d{i % 50}", f"f{i}.py"), "wb") as f:
+            size += f.write(text(rng, rng.randint(1000, 40000)))
+    mb = size / 2**20
+    yield "worktree", files, "files"
+    yield "worktree", mb, "MB"
+
+    for jobs in (1, 2, 4, 8):
+        shutil.rmtree(os.path.join(path, ".git"), ignore_errors=True)
+        git(None, "init", "-q", path)
+        repo = libwyag.repo_find(path)
+        t = timed(lambda: libwyag.add(repo, [ path ], jobs=jobs))
+        yield f"add -j {jobs}", t, "s"
+        yield f"add -j {jobs}", files / t, "files/s"
+        yield f"add -j {jobs}", mb / t, "MB/s"
+
+    for jobs in (1, 2, 4, 8):
+        now = time.time() + jobs
+        for name in libwyag.worktree_files(repo):
+            os.utime(os.path.join(path, name), (now, now))
+        index = libwyag.index_read(repo)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = timed(lambda: libwyag.cmd_status_index_worktree(repo, index, jobs=jobs))
+        yield f"status -j {jobs}", t, "s"
+        yield f"status -j {jobs}", files / t, "files/s"
+        yield f"status -j {jobs}", mb / t, "MB/s"
+
+
+# Run in a child process, so that its peak RSS is the read's alone.
+OBJECT_READ_CHILD = """
+import resource, sys, time, tracemalloc
+sys.path.insert(0, sys.argv[1])
+import libwyag
+repo = libwyag.repo_find(sys.argv[2])
+tracemalloc.start()
+start = time.perf_counter()
+for sha in sys.argv[3:]:
+    fmt, data = libwyag.object_read_raw(repo, sha)
+elapsed = time.perf_counter() - start
+# ru_maxrss survives exec on Linux, and would be our parent's.
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open("/proc/self/status") as f:
+        maxrss = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+except OSError:
+    pass
+print(elapsed, tracemalloc.get_traced_memory()[1], maxrss)
+"""
+
+
+@benchmark
+def bench_object_read(tmp, scale):
+    """Time, traced peak and peak RSS of object_read_raw of one big blob,
+    and of every object of a repository, loose and packed."""
+    rng = random.Random(16)
+    path = os.path.join(tmp, "objects")
+    # Repeating 4MB of text is just as slow to inflate, and faster to
+    # make.
+    size = int(64 * 2**20 * scale)
+    chunk = text(rng, 4 * 2**20)
+    fast_import(path, [ { "big.txt": (chunk * (size // len(chunk) + 1))[:size] } ]
+                + [ { f"d{i % 20}/f{i}.py": text(rng, rng.randint(1000, 20000)) for i in range(j, j + 50) }
+                    for j in range(0, int(500 * scale), 50) ])
+    big = git(path, "rev-parse", "HEAD:big.txt").decode().strip()
+    every = git(path, "cat-file", "--batch-all-objects", "--batch-check=%(objectname)").decode().split()
+
+    def run(shas):
+        out = subprocess.run([sys.executable, "-c", OBJECT_READ_CHILD, ROOT, path, *shas],
+                             check=True, capture_output=True).stdout
+        elapsed, peak, maxrss = out.split()
+        return float(elapsed), int(peak) / 2**20, int(maxrss) / 1024
+
+    for storage in ("packed", "loose"):
+        if storage == "loose":
+            pack_dir = os.path.join(path, ".git", "objects", "pack")
+            for name in os.listdir(pack_dir):
+                if name.endswith(".pack"):
+                    with open(os.path.join(pack_dir, name), "rb") as f:
+                        data = f.read()
+                    for suffix in (".pack", ".idx"):
+                        os.remove(os.path.join(pack_dir, name[:-5] + suffix))
+                    git(path, "unpack-objects", "-q", input=data)
+        for what, shas in ((f"{size / 2**20:.0f}MB blob", [ big ]),
+                           (f"all {len(every)} objects", every)):
+            elapsed, peak, maxrss = run(shas)
+            yield f"{what}, {storage}", elapsed, "s"
+            yield f"{what}, {storage}, traced peak", peak, "MB"
+            yield f"{what}, {storage}, maxrss", maxrss, "MB"
+
+
+@benchmark
+def bench_startup(tmp, scale):
+    """Wall-clock of wyag rev-parse HEAD, median of 20 runs, with and
+    without a bytecode cache and next to a bare python, and the import
+    time of libwyag."""
+    import statistics
+    path = os.path.join(tmp, "startup")
+    fast_import(path, [ { "README": b"wyag\n" } ])
+    runs = max(int(20 * scale), 1)
+    wyag = [ sys.executable, os.path.join(ROOT, "wyag"), "rev-parse", "HEAD" ]
+
+    # Our own bytecode caches, so as not to depend on (or touch) the
+    # ones of the tree.
+    env = dict(os.environ, WYAG_NO_DAEMON="1", PYTHONPYCACHEPREFIX=os.path.join(tmp, "pycache"))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.run(wyag, cwd=path, env=env, check=True, capture_output=True)
+    # And a copy of wyag that never gets one, the rest of python still
+    # using its usual caches.
+    os.mkdir(os.path.join(tmp, "cold"))
+    for name in ("wyag", "libwyag.py"):
+        shutil.copy(os.path.join(ROOT, name), os.path.join(tmp, "cold", name))
+    cold = dict(os.environ, WYAG_NO_DAEMON="1", PYTHONDONTWRITEBYTECODE="1")
+    cold.pop("PYTHONPYCACHEPREFIX", None)
+
+    def median(argv, env):
+        times = list()
+        for _ in range(runs):
+            times.append(timed(lambda: subprocess.run(argv, cwd=path, env=env, check=True,
+                                                      capture_output=True)))
+        return statistics.median(times) * 1000
+
+    yield "python -c pass", median([ sys.executable, "-c", "pass" ], env), "ms"
+    yield "wyag rev-parse HEAD", median(wyag, env), "ms"
+    yield "wyag rev-parse HEAD, no bytecode cache", \
+        median([ sys.executable, os.path.join(tmp, "cold", "wyag"), *wyag[2:] ], cold), "ms"
+
+    # Lines are "import time: self [us] | cumulative | imported package".
+    err = subprocess.run([ sys.executable, "-X", "importtime", *wyag[1:] ],
+                         cwd=path, env=env, check=True, capture_output=True).stderr.decode()
+    for line in err.splitlines():
+        fields = [ f.strip() for f in line.split("|") ]
+        if len(fields) == 3 and fields[2] == "libwyag":
+            yield "import libwyag, cumulative", int(fields[1]) / 1000, "ms"
+
+
+@benchmark
+def bench_tree_diff(tmp, scale):
+    """tree_diff between trees of 100,000 entries that differ by a
+    handful of files, against reading both trees whole and comparing,
+    with cold caches."""
+    rng = random.Random(21)
+    files = int(100000 * scale)
+    path = os.path.join(tmp, "tree-diff")
+    names = [ f"d{i % 100}/s{i // 100 % 10}/f{i}.c" for i in range(files) ]
+    commits = [ { name: b"%d\n" % i for i, name in enumerate(names) } ]
+    for changes in (1, 5, 50):
+        commits.append({ name: b"changed %d\n" % len(commits) for name in rng.sample(names, changes) })
+    fast_import(path, commits)
+
+    def flatten(repo, sha):
+        ret = dict()
+        todo = [ (sha, "") ]
+        while todo:
+            sha, prefix = todo.pop()
+            for leaf in libwyag.object_read(repo, sha).items:
+                if leaf.mode.startswith(b"04"):
+                    todo.append((leaf.sha, prefix + leaf.path + "/"))
+                else:
+                    ret[prefix + leaf.path] = (leaf.mode, leaf.sha)
+        return ret
+
+    def flatten_diff(repo, a, b):
+        a, b = flatten(repo, a), flatten(repo, b)
+        return [ p for p in a.keys() | b.keys() if a.get(p) != b.get(p) ]
+
+    for n in range(1, len(commits)):
+        old = git(path, "rev-parse", f"HEAD~{len(commits) - n}^{{tree}}").decode().strip()
+        new = git(path, "rev-parse", f"HEAD~{len(commits) - n - 1}^{{tree}}").decode().strip()
+        changes = len(commits[n])
+        for name, fn in (("tree_diff", lambda repo: list(libwyag.tree_diff(repo, old, new))),
+                         ("flatten and compare", lambda repo: flatten_diff(repo, old, new))):
+            # A new GitRepo for each run: nothing cached.
+            yield f"{files} entries, {changes} changed, {name}", \
+                timed(lambda: fn(libwyag.repo_find(path)), repeat=3), "s"
+        yield f"{files} entries, {changes} changed, git diff-tree -r", \
+            timed(lambda: git(path, "diff-tree", "-r", old, new), repeat=3), "s"
+
+
+@benchmark
+def bench_diff(tmp, scale):
+    """Unified diffs of a big file with a few edits, with myers,
+    histogram and difflib."""
+    import difflib
+    rng = random.Random(23)
+    a = libwyag.diff_lines(text(rng, int(1500000 * scale)))
+    for edits in (10, 100):
+        b = list(a)
+        for _ in range(edits):
+            i = rng.randrange(len(b))
+            r = rng.random()
+            if r < 0.33:
+                del b[i]
+            elif r < 0.66:
+                b.insert(i, b"new line %d\n" % i)
+            else:
+                b[i] = b"changed\n"
+        for algorithm in libwyag.DIFF_ALGORITHMS:
+            yield f"{len(a)} lines, {edits} edits, {algorithm}", \
+                timed(lambda: list(libwyag.diff_unified(a, b, libwyag.diff_changes(a, b, algorithm))),
+                      repeat=3), "s"
+        yield f"{len(a)} lines, {edits} edits, difflib", \
+            timed(lambda: list(difflib.diff_bytes(difflib.unified_diff, a, b, n=3))), "s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run wyag benchmarks.")
+    parser.add_argument("names", nargs="*", metavar="benchmark",
+                        help=f"Benchmarks to run, among: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--scale", type=float, default=1,
+                        help="Multiply the size of the test repositories")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Append the results to FILE, as JSON lines")
+    args = parser.parse_args(argv)
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}")
+    names = args.names or list(BENCHMARKS)
+
+    try:
+        commit = git(ROOT, "rev-parse", "HEAD").decode().strip()
+    except subprocess.CalledProcessError:
+        commit = None
+    date = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmp:
+            for metric, value, unit in BENCHMARKS[name](tmp, args.scale):
+                print(f"{name}: {metric}: {value:.4g} {unit}", flush=True)
+                if args.record:
+                    with open(args.record, "a") as f:
+                        f.write(json.dumps({ "benchmark": name, "metric": metric, "value": value,
+                                             "unit": unit, "scale": args.scale, "commit": commit,
+                                             "date": date }) + "\n")
+
+if __name__ == "__main__":
+    main()
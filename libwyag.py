@@ -1,25 +1,84 @@
-import argparse
+from array import array
+from bisect import bisect_left
+from heapq import heappop, heappush
+import atexit
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import configparser
-from datetime  import datetime
-import grp, pwd # to read the users/group database on Unix
-from fnmatch import fnmatch
 import hashlib
-from math import ceil
+import itertools
+import mmap
 import os
 import re
+import stat
+import struct
 import sys
+import threading
+import time
 import zlib
 
 
 #fisrt we need to set the format of CLI commands!
 
-argparser = argparse.ArgumentParser(description="The stupidest content tracker")
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+# Building the argparse parsers of every command (and importing
+# argparse at all) is a good part of what a short command like rev-parse
+# costs.  So commands register into argsubparsers, which only records
+# what they ask for, and main() builds a parser for the one being run.
 
+class GitCommand(object):
+    """The arguments of a command, as given to add_parser() and
+    add_argument(), to be replayed on a real parser."""
+
+    # Whether, like in git, what follows "--" on the command line are
+    # paths, to append to args.path.
+    paths = False
+
+    def __init__(self, name, kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.arguments = list()
+
+    def add_argument(self, *args, **kwargs):
+        self.arguments.append((args, kwargs))
+
+class GitCommandRegistry(dict):
+    def add_parser(self, name, **kwargs):
+        self[name] = GitCommand(name, kwargs)
+        return self[name]
+
+argsubparsers = GitCommandRegistry()
+
+def argparser_build(argv):
+    import argparse
+    argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+    subparsers = argparser.add_subparsers(title="Commands", dest="command")
+    subparsers.required = True
+
+    # Everything if we don't know the command yet: --help, a typo...
+    names = argv[:1] if argv and argv[0] in argsubparsers else sorted(argsubparsers)
+    for name in names:
+        command = argsubparsers[name]
+        argsp = subparsers.add_parser(name, **command.kwargs)
+        for args, kwargs in command.arguments:
+            argsp.add_argument(*args, **kwargs)
+    return argparser
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+    # Read-only commands go to the daemon, if one serves this repository.
+    status = daemon_forward(argv)
+    if status is not None:
+        sys.exit(status)
+
+    # argparse would give what follows "--" to the first positional it
+    # can, be it a revision: set the paths aside ourselves.
+    paths = None
+    if argv and argv[0] in argsubparsers and argsubparsers[argv[0]].paths and "--" in argv:
+        i = argv.index("--")
+        argv, paths = argv[:i], argv[i+1:]
+
+    args = argparser_build(argv).parse_args(argv)
+    if paths is not None:
+        args.path += paths
     match args.command:
 
         case "add": cmd_add(args)
@@ -27,16 +86,23 @@ def main(argv=sys.argv[1:]):
         case "check-ignore": cmd_check_ignore(args)
         case "checkout": cmd_checkout(args)
         case "commit": cmd_commit(args)
+        case "commit-graph": cmd_commit_graph(args)
+        case "daemon": cmd_daemon(args)
+        case "diff": cmd_diff(args)
+        case "diff-tree": cmd_diff_tree(args)
+        case "gc": cmd_gc(args)
         case "hash-object": cmd_hash_object(args)
         case "init": cmd_init(args)
         case "log": cmd_log(args)
         case "ls-files": cmd_ls_files(args)
         case "ls-tree": cmd_ls_tree(args)
+        case "pack-refs": cmd_pack_refs(args)
         case "rev-parse": cmd_rev_parse(args)
         case "rm": cmd_rm(args)
         case "show-ref": cmd_show_ref(args)
         case "status": cmd_status(args)
         case "tag": cmd_tag(args)
+        case "write-tree": cmd_write_tree(args)
         case _ : print("Bad command.")
 
 
@@ -44,6 +110,9 @@ class GitRepo(object):
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    commit_graph = None
+    packed_refs = None
 
     # initilizing the repo object : first we should check if there is any git repository in the given path!
     def __init__(self, path, force=False):
@@ -61,6 +130,83 @@ class GitRepo(object):
             vers = int(self.conf.get("core", "repositoryformatversion"))
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion: {vers}")
+
+        # Like git, favour speed over size for loose objects: gc will
+        # recompress them anyway.
+        self.loose_compression = self.conf.getint(
+            "core", "loosecompression",
+            fallback=self.conf.getint("core", "compression", fallback=1))
+
+        # Loose refs we've read, by path: ((mtime, size, inode), content)
+        self.ref_cache = dict()
+        # Sorted SHAs of the loose objects, per fanout directory.
+        self.loose_index = dict()
+
+        # Objects are immutable, so we can keep the ones we've already
+        # inflated (raw_cache) and parsed (object_cache) around.
+        self.raw_cache = GitObjectCache(
+            config_size(self.conf.get("wyag", "rawcachesize", fallback="32m")))
+        self.object_cache = GitObjectCache(
+            config_size(self.conf.get("wyag", "objectcachesize", fallback="32m")))
+        if os.environ.get("WYAG_CACHE_STATS"):
+            atexit.register(repo_print_cache_stats, self)
+
+def repo_print_cache_stats(repo):
+    """Diagnostics: how well did the object caches do?"""
+    for name in ("raw_cache", "object_cache"):
+        stats = getattr(repo, name).stats()
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['entries']} entries, {stats['bytes']}/{stats['limit']} bytes",
+              file=sys.stderr)
+
+def config_size(value):
+    """Parse a size with an optional k, m or g suffix, like git does."""
+    value = value.strip().lower()
+    units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+class GitObjectCache(object):
+    """A least-recently-used cache, bounded by the total size in bytes of
+    what it holds rather than by its number of entries."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = OrderedDict() # key -> (value, size)
+        self.hits = 0
+        self.misses = 0
+        # Checkout reads objects from several threads.
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        # Don't let a single huge object flush everything else.
+        if size > self.limit // 4:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def stats(self):
+        return { "hits": self.hits, "misses": self.misses,
+                 "entries": len(self.entries), "bytes": self.size,
+                 "limit": self.limit }
             
 
 def repo_path(repo, *path):
@@ -87,7 +233,8 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception(f"Not a directory {path}")
 
     if mkdir:
-        os.makedirs(path)
+        # Another thread may be creating it at the same time.
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -160,20 +307,29 @@ argsp.add_argument("path", metavar="directory", nargs="?", default=".", help="Wh
 def cmd_init(args):
     repo_create(args.path)
 
+# When set (by the daemon), worktree -> GitRepo: repo_find() then hands
+# out the same GitRepo, caches included, to every command.
+repo_instances = None
+
 def repo_find(path='.', required=True):
+    # One realpath is enough: the parents of a real path are real.
     path = os.path.realpath(path)
-    if os.path.isdir(os.path.join(path,".git")):
-        return GitRepo(path)
-    
-    # If we haven't returned, recurse in parent
-    parent = os.path.realpath(os.path.join(path, ".."))
-    if parent == path:
-        if required:
-            raise Exception("No git directory.")
-        else:
-            return None
-        
-    return repo_find(parent, required)
+    while True:
+        if os.path.isdir(os.path.join(path,".git")):
+            if repo_instances is None:
+                return GitRepo(path)
+            if path not in repo_instances:
+                repo_instances[path] = GitRepo(path)
+            return repo_instances[path]
+
+        # If we haven't returned, try the parent
+        parent = os.path.dirname(path)
+        if parent == path:
+            if required:
+                raise Exception("No git directory.")
+            else:
+                return None
+        path = parent
 
 
 # now we creat an object!
@@ -202,52 +358,517 @@ What exactly that means depend on each subclass."""
 
 def object_read(repo, sha):
     """Read object sha from Git repository repo.  Return a
-    GitObject whose exact type depends on the object."""
+    GitObject whose exact type depends on the object.
 
-    path = repo_file(repo,"objects",sha[0:2], sha[2:])
-    if not os.path.isfile(path):
+    Commits and trees are cached already parsed, and shared between
+    callers: don't modify what you get back."""
+
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return obj
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
         return None
-    
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
-
-        # Read object file:
-        x = raw.find(b' ')
-        fmt = raw[0:x]
-        # Read and validate object size
-        y = raw.find(b'\x00', x)
-        size  = int(raw[x:y].decode("ascii"))
+    fmt, data = raw
+
+    # pick the suitable constructor:
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode("ascii")} for object {sha}")
+
+    # Call constructor and return object
+    obj = c(data)
+    if fmt == b'commit' or fmt == b'tree':
+        repo.object_cache.put(sha, obj, len(data))
+    return obj
+
+def object_read_raw(repo, sha):
+    """Read object sha as a (fmt, data) pair, without parsing it.  Loose
+    objects are tried first, then every packfile.  Return None if the
+    object doesn't exist.
+
+    data is a read-only memoryview: on the buffer the object was
+    inflated into, without its header for loose objects.  It's shared
+    with the cache, which is why it must stay read-only."""
+
+    raw = repo.raw_cache.get(sha)
+    if raw is not None:
+        return raw
+
+    path = repo_file(repo,"objects",sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            # Inflate the header alone first: once we know the size, the
+            # whole object is inflated in one go into a buffer of the
+            # right size, straight from the map.
+            head = zlib.decompressobj().decompress(m[:4096], 64)
+            x = head.find(b' ')
+            fmt = head[0:x]
+            y = head.find(b'\x00', x)
+            size = int(head[x:y].decode("ascii"))
+            raw = zlib.decompress(m, bufsize=y+1+size)
+
+        # Validate object size
         if size != len(raw)-y-1:
             raise Exception(f"Malformed object {sha}: bad length")
 
-        # pick the suitable constructor:
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception(f"Unknown type {fmt.decode("ascii")} for object {sha}")
-
-        # Call constructor and return object
-        return c(raw[y+1:])
-    
+        # Skip the header without copying the payload.
+        raw = (fmt, memoryview(raw)[y+1:].toreadonly())
+    else:
+        binsha = bytes.fromhex(sha)
+        for pack in repo_packs(repo):
+            offset = pack_find(pack, binsha)
+            if offset is not None:
+                raw = pack_read(repo, pack, offset)
+                break
+        else:
+            return None
+
+    repo.raw_cache.put(sha, raw, len(raw[1]))
+    return raw
+
 def object_write(obj: GitObject, repo=None):
     data = obj.serialize()
-    result = obj.ftm + b' ' + str(len(data)).encode() + b'\x00' + data
-    sha = hashlib.sha1(result).hexdigest()
+    header = obj.fmt + b' ' + str(len(data)).encode() + b'\x00'
+    # Hash and compress header and data separately, instead of paying
+    # for a copy of the whole object just to prepend a few bytes.
+    h = hashlib.sha1(header)
+    h.update(data)
+    sha = h.hexdigest()
 
     if repo:
         path=repo_file(repo,"objects", sha[0:2], sha[2:], mkdir=True)
         if not os.path.exists(path):
             with open(path,'wb') as f:
                 #Compress it and Write:
-                f.write(zlib.compress(result))
+                c = zlib.compressobj(repo.loose_compression)
+                f.write(c.compress(header))
+                f.write(c.compress(data))
+                f.write(c.flush())
+            object_index_add(repo, sha)
     
     return sha
 
+# Streaming
+# =========
+#
+# Blobs can be much bigger than what we want to hold in memory.  These
+# two functions move them between files and the object store a chunk
+# at a time.
+
+STREAM_CHUNK = 1024 * 1024
+
+def object_write_stream(fd, fmt, repo=None):
+    """Hash (and write, if repo is given) the content of file fd as an
+    object of type fmt, without ever holding more than a chunk of it."""
+    size = os.fstat(fd.fileno()).st_size
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+    h = hashlib.sha1(header)
+
+    tmp = None
+    if repo:
+        tmp_path = os.path.join(repo_dir(repo, "objects", mkdir=True), f"tmp_obj_{os.getpid()}_{threading.get_ident()}")
+        tmp = open(tmp_path, "wb")
+        c = zlib.compressobj(repo.loose_compression)
+        tmp.write(c.compress(header))
+
+    try:
+        read = 0
+        while True:
+            chunk = fd.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+            h.update(chunk)
+            if tmp:
+                tmp.write(c.compress(chunk))
+        if read != size:
+            raise Exception(f"File changed while hashing: read {read} bytes, expected {size}")
+        if tmp:
+            tmp.write(c.flush())
+            tmp.close()
+    except:
+        if tmp:
+            tmp.close()
+            os.remove(tmp_path)
+        raise
+
+    sha = h.hexdigest()
+    if tmp:
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+            object_index_add(repo, sha)
+    return sha
+
+def object_read_stream(repo, sha, out):
+    """Write the content of object sha to the file out.  Loose objects and
+    undeltified packed ones are inflated a chunk at a time; deltas need
+    their whole base anyway, so they go through object_read_raw."""
+    raw = repo.raw_cache.get(sha)
+    if raw is not None:
+        out.write(raw[1])
+        return
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            d = zlib.decompressobj()
+            head = b''
+            while True:
+                # Bound the output too: a tiny input can inflate a lot.
+                data = d.unconsumed_tail or f.read(STREAM_CHUNK)
+                if not data:
+                    break
+                data = d.decompress(data, STREAM_CHUNK)
+                if head is not None:
+                    # Strip the "fmt size\0" header
+                    head += data
+                    y = head.find(b'\x00')
+                    if y < 0:
+                        continue
+                    data = head[y+1:]
+                    head = None
+                out.write(data)
+            out.write(d.flush())
+            if not d.eof:
+                raise Exception(f"Truncated object {sha}")
+        return
+
+    binsha = bytes.fromhex(sha)
+    for pack in repo_packs(repo):
+        offset = pack_find(pack, binsha)
+        if offset is None:
+            continue
+        type, size, pos = pack_entry_header(pack, offset)
+        if type not in PACK_TYPES:
+            out.write(pack_read(repo, pack, offset)[1])
+            return
+        view = memoryview(pack.data)
+        d = zlib.decompressobj()
+        while not d.eof:
+            data = d.unconsumed_tail
+            if not data:
+                if pos >= len(view):
+                    raise Exception(f"Truncated object in {pack.path}")
+                data = view[pos:pos+STREAM_CHUNK]
+                pos += STREAM_CHUNK
+            out.write(d.decompress(data, STREAM_CHUNK))
+        return
+
+    raise Exception(f"No such object {sha}")
+
+# Packfiles
+# =========
+#
+# Once a repository has been gc'd, most of its objects don't live in
+# .git/objects/xx/yyyy anymore but in .git/objects/pack/pack-*.pack,
+# each with a matching .idx.  The index (version 2) is laid out as:
+#
+#   magic "\377tOc", version (4 bytes)
+#   fanout table: 256 big-endian uint32, entry i is the number of
+#   objects whose first byte is <= i
+#   N sorted 20-byte SHAs
+#   N CRC32s
+#   N 4-byte offsets (MSB set means: index into the 8-byte table below)
+#   8-byte offsets for packs bigger than 2GB
+#   pack checksum, index checksum
+#
+# Both files are mmapped, so we only ever touch the pages we need.
+
+PACK_TYPES = { 1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag' }
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+class GitPack(object):
+    def __init__(self, path):
+        # path is the .pack file, the index sits next to it.
+        self.path = path
+        with open(path[:-5] + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != b"\377tOc":
+            raise Exception(f"Unsupported pack index format for {path}")
+        version = int.from_bytes(self.idx[4:8], "big")
+        if version != 2:
+            raise Exception(f"Unsupported pack index version {version} for {path}")
+        if self.data[0:4] != b"PACK":
+            raise Exception(f"Not a packfile: {path}")
+
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self.sha_table = 8 + 256*4
+        self.crc_table = self.sha_table + 20*self.count
+        self.offset_table = self.crc_table + 4*self.count
+        self.large_offset_table = self.offset_table + 4*self.count
+
+def repo_packs(repo):
+    """Return the list of packs in repo, loading their indexes on first use."""
+    if repo.packs is None:
+        repo.packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".pack") and os.path.isfile(os.path.join(path, f[:-5] + ".idx")):
+                    repo.packs.append(GitPack(os.path.join(path, f)))
+    return repo.packs
+
+def pack_sha(pack, n):
+    """Return the binary SHA of the n-th object in the pack index."""
+    pos = pack.sha_table + 20*n
+    return pack.idx[pos:pos+20]
+
+def pack_offset(pack, n):
+    """Return the offset in the .pack of the n-th object of the index."""
+    offset = struct.unpack_from(">I", pack.idx, pack.offset_table + 4*n)[0]
+    if offset & 0x80000000:
+        offset = struct.unpack_from(">Q", pack.idx, pack.large_offset_table + 8*(offset & 0x7fffffff))[0]
+    return offset
+
+def pack_bisect(pack, binsha):
+    """Return the position of the first index entry >= binsha.  The
+    fanout table narrows the search to objects sharing the first byte."""
+    first = binsha[0]
+    lo = pack.fanout[first-1] if first else 0
+    hi = pack.fanout[first]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pack_sha(pack, mid) < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def pack_find(pack, binsha):
+    """Return the offset of binsha in pack, or None."""
+    n = pack_bisect(pack, binsha)
+    if n < pack.count and pack_sha(pack, n) == binsha:
+        return pack_offset(pack, n)
+    return None
+
+def pack_prefix(pack, prefix):
+    """Return the hex SHAs of every object in pack starting with the hex
+    string prefix."""
+    ret = list()
+    n = pack_bisect(pack, bytes.fromhex(prefix.ljust(40, "0")))
+    while n < pack.count:
+        sha = pack_sha(pack, n).hex()
+        if not sha.startswith(prefix):
+            break
+        ret.append(sha)
+        n += 1
+    return ret
+
+def pack_entry_header(pack, offset):
+    """Read the variable-length header of the entry at offset.  Return
+    (type, inflated size, offset of what follows)."""
+    data = pack.data
+    c = data[offset]
+    type = (c >> 4) & 0b111
+    size = c & 0b1111
+    shift = 4
+    offset += 1
+    while c & 0x80:
+        c = data[offset]
+        size |= (c & 0x7f) << shift
+        shift += 7
+        offset += 1
+    return type, size, offset
+
+def pack_inflate(pack, offset, size):
+    """Inflate the zlib stream starting at offset.  The decompressor
+    reads straight from the map, stops at the end of the stream, and
+    writes into a single buffer of the size the entry header gave: no
+    chunks to join and no unused_data to copy."""
+    try:
+        ret = zlib.decompress(memoryview(pack.data)[offset:], bufsize=size)
+    except zlib.error as e:
+        raise Exception(f"Corrupt object in {pack.path} at {offset}: {e}")
+    if len(ret) != size:
+        raise Exception(f"Malformed object in {pack.path}: bad length")
+    return ret
+
+def pack_read(repo, pack, offset):
+    """Read the object at offset in pack, resolving delta chains
+    iteratively.  Return (fmt, data)."""
+    deltas = list()
+    while True:
+        type, size, pos = pack_entry_header(pack, offset)
+
+        if type == PACK_OFS_DELTA:
+            # The base is at a negative offset from this entry, encoded
+            # as a big-endian varint where each continuation adds one.
+            c = pack.data[pos]
+            pos += 1
+            base_distance = c & 0x7f
+            while c & 0x80:
+                c = pack.data[pos]
+                pos += 1
+                base_distance = ((base_distance + 1) << 7) | (c & 0x7f)
+            deltas.append(pack_inflate(pack, pos, size))
+            offset -= base_distance
+
+        elif type == PACK_REF_DELTA:
+            base_sha = pack.data[pos:pos+20]
+            deltas.append(pack_inflate(pack, pos+20, size))
+            base_offset = pack_find(pack, base_sha)
+            if base_offset is None:
+                # The base lives somewhere else (loose or another pack)
+                base = object_read_raw(repo, base_sha.hex())
+                if base is None:
+                    raise Exception(f"Missing delta base {base_sha.hex()} in {pack.path}")
+                fmt, data = base
+                break
+            offset = base_offset
+
+        elif type in PACK_TYPES:
+            fmt = PACK_TYPES[type]
+            data = pack_inflate(pack, pos, size)
+            break
+
+        else:
+            raise Exception(f"Unknown pack entry type {type} in {pack.path}")
+
+    # Apply deltas from the one closest to the base up to ours.
+    for delta in reversed(deltas):
+        data = delta_apply(data, delta)
+
+    return fmt, memoryview(data).toreadonly()
+
+def pack_read_header(repo, pack, offset):
+    """Return (fmt, size) of the object at offset.  For a delta, the
+    size is at the start of the delta itself, and the type is the one
+    of the base at the end of the chain: only headers are read."""
+    type, size, pos = pack_entry_header(pack, offset)
+    if type in PACK_TYPES:
+        return PACK_TYPES[type], size
+
+    # The delta starts with the sizes of its base and of its result.
+    if type == PACK_OFS_DELTA:
+        while pack.data[pos] & 0x80:
+            pos += 1
+        pos += 1
+    elif type == PACK_REF_DELTA:
+        pos += 20
+    else:
+        raise Exception(f"Unknown pack entry type {type} in {pack.path}")
+    # Inflate just enough for both varints to end.  A few compressed
+    # bytes may inflate to nothing (a dynamic Huffman block starts with
+    # its tables), so keep feeding until they do.
+    d = zlib.decompressobj()
+    data = memoryview(pack.data)
+    head = b""
+    while sum(1 for c in head if not c & 0x80) < 2:
+        if d.eof or pos >= len(data):
+            raise Exception(f"Truncated delta header at {offset} in {pack.path}")
+        head += d.decompress(data[pos:pos+64])
+        pos += 64
+    _, hpos = delta_varint(head, 0)
+    size, _ = delta_varint(head, hpos)
+
+    # Walk down the chain to the base for the type.
+    while type not in PACK_TYPES:
+        type, _, pos = pack_entry_header(pack, offset)
+        if type == PACK_OFS_DELTA:
+            c = pack.data[pos]
+            pos += 1
+            base_distance = c & 0x7f
+            while c & 0x80:
+                c = pack.data[pos]
+                pos += 1
+                base_distance = ((base_distance + 1) << 7) | (c & 0x7f)
+            offset -= base_distance
+        elif type == PACK_REF_DELTA:
+            base_sha = pack.data[pos:pos+20]
+            base_offset = pack_find(pack, base_sha)
+            if base_offset is None:
+                base = object_read_header(repo, base_sha.hex())
+                if base is None:
+                    raise Exception(f"Missing delta base {base_sha.hex()} in {pack.path}")
+                return base[0], size
+            offset = base_offset
+    return PACK_TYPES[type], size
+
+def delta_varint(delta, pos):
+    """Read a little-endian size varint, as used in delta headers."""
+    value = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+def delta_apply(base, delta):
+    """Rebuild an object from its base and a git delta.  A delta is two
+    sizes (source, target) followed by instructions: either copy a range
+    of the base (MSB set) or insert the next n bytes of the delta."""
+    src_size, pos = delta_varint(delta, 0)
+    dst_size, pos = delta_varint(delta, pos)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch")
+
+    base = memoryview(base)
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy: the low 4 bits say which offset bytes follow, the
+            # next 3 which size bytes follow.  A size of 0 means 0x10000.
+            # This is the hottest loop of checkout, hence the unrolling.
+            offset = 0
+            size = 0
+            if op & 0x01:
+                offset = delta[pos]
+                pos += 1
+            if op & 0x02:
+                offset |= delta[pos] << 8
+                pos += 1
+            if op & 0x04:
+                offset |= delta[pos] << 16
+                pos += 1
+            if op & 0x08:
+                offset |= delta[pos] << 24
+                pos += 1
+            if op & 0x10:
+                size = delta[pos]
+                pos += 1
+            if op & 0x20:
+                size |= delta[pos] << 8
+                pos += 1
+            if op & 0x40:
+                size |= delta[pos] << 16
+                pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset+size]
+        elif op:
+            # Insert
+            out += delta[pos:pos+op]
+            pos += op
+        else:
+            raise Exception("Bad delta opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Delta result size mismatch")
+    # No bytes() copy: the caller wraps it in a read-only memoryview.
+    return out
+
 class GitBlob(GitObject):
-    ftm=b'blob'
+    fmt=b'blob'
     def serialize(self):
         return self.blobdata
     def deserialize(self, data):
@@ -258,23 +879,87 @@ argsp = argsubparsers.add_parser("cat-file",
 
 argsp.add_argument("type",
                    metavar="type",
+                   nargs="?",
                    choices=["blob", "commit", "tag", "tree"],
                    help="Specify the type")
 
 argsp.add_argument("object",
                    metavar="object",
+                   nargs="?",
                    help="The object to display")
 
+argsp.add_argument("--batch",
+                   action="store_true",
+                   help="Print the header and content of each object named on stdin")
+
+argsp.add_argument("--batch-check",
+                   action="store_true",
+                   help="Print the header of each object named on stdin")
+
+argsp.add_argument("--buffer",
+                   action="store_true",
+                   help="In batch mode, don't flush after every object")
+
 def cmd_cat_file(args):
     repo = repo_find()
+    if args.batch or args.batch_check:
+        cat_file_batch(repo, sys.stdin, sys.stdout.buffer,
+                       content=args.batch, flush=not args.buffer)
+        return
+    if not args.type or not args.object:
+        raise Exception("cat-file needs a type and an object, or --batch")
     cat_file(repo, args.object, fmt=args.type.encode())
 
 def cat_file(repo, obj, fmt=None):
     obj = object_read(repo,object_find(repo,obj,fmt=fmt))
 
-    sys.stdout.buffer.write(obj.serialize)
-
-
+    sys.stdout.buffer.write(obj.serialize())
+
+def cat_file_batch(repo, names, out, content=True, flush=True):
+    """For each object name in names, write "<sha> <type> <size>\\n",
+    followed by the content and a newline if content is set.  The whole
+    session shares one repo, and so its caches.  Unless flush is off,
+    every answer is flushed so that a caller can wait for it before
+    asking for the next object."""
+    for name in names:
+        name = name.rstrip("\n")
+        if not name:
+            continue
+        shas = object_resolve(repo, name) or [ None ]
+        if len(shas) > 1:
+            out.write(f"{name} ambiguous\n".encode())
+        else:
+            sha = shas[0]
+            header = object_read_header(repo, sha) if sha else None
+            if header is None:
+                out.write(f"{name} missing\n".encode())
+            else:
+                fmt, size = header
+                out.write(f"{sha} {fmt.decode('ascii')} {size}\n".encode())
+                if content:
+                    object_read_stream(repo, sha, out)
+                    out.write(b"\n")
+        if flush:
+            out.flush()
+    out.flush()
+
+def object_read_header(repo, sha):
+    """Return (fmt, size) of object sha, or None if it doesn't exist,
+    inflating as little of it as possible."""
+    raw = repo.raw_cache.get(sha)
+    if raw is not None:
+        return raw[0], len(raw[1])
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if path and os.path.isfile(path):
+        return loose_object_header(path)
+
+    binsha = bytes.fromhex(sha)
+    for pack in repo_packs(repo):
+        offset = pack_find(pack, binsha)
+        if offset is not None:
+            return pack_read_header(repo, pack, offset)
+    return None
 
 """$ wyag checkout v3.11 # A tag
 $ wyag checkout feature/explosions # A branch
@@ -290,7 +975,12 @@ def object_find(repo, name, fmt=None, follow=True):
     if not sha:
         raise Exception(f"No such reference {name}.")
     if len(sha)>1:
-        raise Exception("Ambiguous reference {name}: Candidates are:\n - {'\n - '.join(sha)}.")
+        candidates = list()
+        for c in sha:
+            # Only the type is wanted: don't inflate whole objects.
+            header = object_read_header(repo, c)
+            candidates.append(f"{c} {header[0].decode('ascii') if header else 'unreadable'}")
+        raise Exception(f"Ambiguous reference {name}: Candidates are:\n - {'\n - '.join(candidates)}.")
 
     sha = sha[0]
 
@@ -343,6 +1033,10 @@ def cmd_hash_object(args):
 
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+    if fmt == b'blob':
+        # No need to parse blobs: stream them.
+        return object_write_stream(fd, fmt, repo)
+
     data = fd.read()
 
     # choose constructor according to fmt argument
@@ -355,61 +1049,95 @@ def object_hash(fd, fmt, repo=None):
 
     return object_write(obj, repo)
 
-def kvlm_parse(raw, start=0, dct=None):
-    if not dct:
-        dct=dict()
-    
-    # we want to recursivly read a key/value pair and call it self back with new positions!
-    # at first we need to know where we are, at a keyword? or at a messageQ?
-    # the format I am using is RFC 2822 you can find it here: https://www.ietf.org/rfc/rfc2822.txt
-    # lines of information for a given part are seperated with a space charachter!
-
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # if there is a space before newline, we have a keyword. Otherwise it's the final message, which we just read to the end of the file
-    
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.  We store it in
-    # the dictionary, with None as the key, and return.
-    
-    
-    if (spc<0) or (nl<spc):
-        assert nl == start
-        dct[None] = raw[start+1:]
-        return dct
-    
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    key = raw[start:spc]
+# the format I am using is RFC 2822 you can find it here: https://www.ietf.org/rfc/rfc2822.txt
+# Each header is "key value\n".  A value can go on over several lines,
+# continuation lines begin with a space.  A blank line ends the headers,
+# everything after it is the message.
+KVLM_HEADER_RE = re.compile(rb'([^ \n]+) ([^\n]*)((?:\n [^\n]*)*)\n')
 
-    # Find the end of the value.  Continuation lines begin with a space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
+class KvlmSpans(list):
+    """The (start, end, continued) spans of a value not read yet."""
+    pass
 
-    # now we should grab the value and delete the spcae (in the start of the line) to have access to the full data
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+class GitKvlm(MutableMapping):
+    """Key-Value List with Message, as parsed by kvlm_parse.
+
+    It behaves like the dict it used to be, but values stay spans over
+    the raw buffer until someone reads them.  As long as nothing was
+    modified, serializing gives back the raw buffer itself."""
+
+    def __init__(self, raw=None):
+        self.raw = raw
+        self.dct = dict()
+        self.clean = raw is not None
+
+    def __getitem__(self, key):
+        value = self.dct[key]
+        if type(value) is KvlmSpans:
+            values = [ kvlm_span(self.raw, *span) for span in value ]
+            value = values[0] if len(values) == 1 else values
+            self.dct[key] = value
+        if type(value) == list:
+            # The caller may modify it behind our back.
+            self.clean = False
+        return value
+
+    def __setitem__(self, key, value):
+        self.dct[key] = value
+        self.clean = False
+
+    def __delitem__(self, key):
+        del self.dct[key]
+        self.clean = False
+
+    def __contains__(self, key):
+        return key in self.dct
+
+    def __iter__(self):
+        return iter(self.dct)
+
+    def __len__(self):
+        return len(self.dct)
+
+def kvlm_span(raw, start, end, continued):
+    value = bytes(raw[start:end])
+    if continued:
+        # delete the space at the start of continuation lines
+        value = value.replace(b'\n ', b'\n')
+    return value
+
+def kvlm_parse(raw):
+    """Parse the headers and message of a commit or tag.  raw can be
+    bytes or a memoryview; it is scanned in a single loop and nothing is
+    copied but the keys."""
+    kvlm = GitKvlm(raw)
+    dct = kvlm.dct
+    match = KVLM_HEADER_RE.match
+    pos = 0
+    end = len(raw)
+    while pos < end and raw[pos] != 0x0a:
+        m = match(raw, pos)
+        if not m:
+            raise Exception(f"Malformed header at offset {pos}")
+        key = m.group(1)
+        span = (m.start(2), m.end(3), m.end(3) != m.start(3))
+        if key in dct:
+            dct[key].append(span)
         else:
-            dct[key] = [ dct[key], value ]
-    else:
-        dct[key] = value
+            dct[key] = KvlmSpans([ span ])
+        pos = m.end()
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
+    # A blank line: the rest is the message, stored with None as the key.
+    dct[None] = KvlmSpans([ (pos+1, end, False) ])
+    return kvlm
 
 # Key-Value List with Message
 def kvlm_serialize(kvlm):
     """write all fields first, then a newline, the message, and a final newline"""
-    ret = b''
+    if type(kvlm) is GitKvlm and kvlm.clean:
+        return bytes(kvlm.raw)
 
+    ret = list()
     for k in kvlm.keys():
         #skip the message
         if k == None: continue
@@ -419,11 +1147,10 @@ def kvlm_serialize(kvlm):
             val = [ val ]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            ret += [ k, b' ', v.replace(b'\n', b'\n '), b'\n' ]
 
-        ret += b'\n' + kvlm[None]
-
-    return ret
+    ret += [ b'\n', kvlm[None] ]
+    return b''.join(ret)
 
 
 class GitCommit(GitObject):
@@ -440,6 +1167,7 @@ class GitCommit(GitObject):
 
 
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
+argsp.paths = True
 argsp.add_argument(
     "commit",
     default="HEAD",
@@ -447,115 +1175,429 @@ argsp.add_argument(
     help="Commit to start at."
 )
 
+argsp.add_argument("path",
+                   nargs="*",
+                   help="Only show the commits that changed these paths (after --)")
 
-# usage of log is aas below:
-# wyag log e03158242ecab460f31b0d6ae1642880577ccbe8 > log.dot dot -O -Tpdf log.dot
+argsp.add_argument("-n", "--max-count",
+                   dest="max_count",
+                   type=int,
+                   help="Show at most that many commits")
 
-def cmd_log(args):
-    repo = repo_find()
+argsp.add_argument("--since", "--after",
+                   dest="since",
+                   help="Show commits more recent than a date")
 
-    print("digraph wyaglog{")
-    print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
+argsp.add_argument("--until", "--before",
+                   dest="until",
+                   help="Show commits older than a date")
 
-def log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    seen.add(sha)
+argsp.add_argument("--first-parent",
+                   action="store_true",
+                   help="Only follow the first parent of merges")
 
-    commit = object_read(repo,sha)
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\","\\\\")
-    message = message.replace("\"", "\\\"")
+argsp.add_argument("--topo-order",
+                   dest="order",
+                   action="store_const",
+                   const="topo",
+                   help="Show no parent before all its children, and don't intermix lines of history")
 
-    # Keep only the first line
-    if "\n" in message:
-        message = message[:message.index("\n")]
-    print(f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]")
-    assert commit.fmt==b'commit'
+argsp.add_argument("--date-order",
+                   dest="order",
+                   action="store_const",
+                   const="date",
+                   help="Show no parent before all its children, else by commit date")
 
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the init   ial commit.
-        return
+argsp.add_argument("--graphviz",
+                   action="store_true",
+                   help="Output the history graph in Graphviz format")
 
-    parents = commit.kvlm[b'parent']
+# usage of --graphviz is as below:
+# wyag log --graphviz e03158242ecab460f31b0d6ae1642880577ccbe8 > log.dot dot -O -Tpdf log.dot
 
-    if type(parents) != list:
-        parents = [ parents ]
+def cmd_log(args):
+    repo = repo_find()
+
+    if args.graphviz:
+        print("digraph wyaglog{")
+        print("  node[shape=rect]")
+        log_graphviz(repo, object_find(repo, args.commit), set())
+        print("}")
+        return
 
-    for p in parents:
-        p = p.decode("ascii")
+    since = log_date_parse(args.since) if args.since else None
+    until = log_date_parse(args.until) if args.until else None
+    paths = [ worktree_relpath(repo, path) for path in args.path ]
+    if "" in paths:
+        # The whole worktree: no limit at all.
+        paths = []
+    walk = log_walk(repo, [ object_find(repo, args.commit, fmt=b"commit") ],
+                    args.order, args.first_parent, since, until, paths)
+    if args.max_count is not None:
+        walk = itertools.islice(walk, max(args.max_count, 0))
+    first = True
+    try:
+        for sha in walk:
+            if not first:
+                print()
+            first = False
+            log_print(repo, sha)
+    except BrokenPipeError:
+        # Whoever reads us (head, a pager) has seen enough: stop quietly,
+        # like git, even when Python flushes stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+def log_graphviz(repo, sha, seen):
+    # We walk the history depth-first, like a recursive walk would, but
+    # with our own stack: long histories would blow Python's.
+    def visit(sha):
+        if sha in seen:
+            return None
+        seen.add(sha)
+
+        commit = object_read(repo,sha)
+        assert commit.fmt==b'commit'
+        message = commit.kvlm[None].decode("utf8").strip()
+        message = message.replace("\\","\\\\")
+        message = message.replace("\"", "\\\"")
+
+        # Keep only the first line
+        if "\n" in message:
+            message = message[:message.index("\n")]
+        print(f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]")
+        return iter(commit_parents(repo, sha))
+
+    stack = [ (sha, visit(sha)) ]
+    while stack:
+        sha, parents = stack[-1]
+        p = next(parents, None) if parents else None
+        if p is None:
+            stack.pop()
+            continue
         print (f"  c_{sha} -> c_{p};")
-        log_graphviz(repo, p, seen)
+        stack.append((p, visit(p)))
+
+# Walking history
+# ---------------
+#
+# By default, commits come out of a priority queue on their commit
+# date: the most recent one is shown, its parents go in the queue, and
+# so on.  Each commit is shown as soon as it's popped, so log -n 10 only
+# ever reads a few commits, however long the history.
+#
+# --topo-order and --date-order also promise that no commit is shown
+# before all its children, and that needs to know all of them.  With
+# generation numbers (from the commit-graph), a commit's children all
+# have a higher generation than it: once every commit with a generation
+# at least as high has been explored, we know how many children it has.
+# So we explore, in decreasing generation order, only as deep as the
+# next commit to show requires, like git does.  Without a commit-graph,
+# every generation is "infinite", and the whole history gets explored
+# first.
+
+def log_walk(repo, starts, order=None, first_parent=False, since=None, until=None, paths=None):
+    """Yield the SHAs of the commits reachable from starts, most recent
+    first.  order is None, "date" or "topo" for --date-order or
+    --topo-order.  since and until are timestamps, to only yield the
+    commits dated between them.  If paths, only the commits that changed
+    them are yielded, see log_simplify()."""
+    keys = bloom_keys(repo, paths) if paths else None
+    infos = dict()
+    def info(sha):
+        ret = infos.get(sha)
+        if ret is None:
+            tree, parents, generation, date = commit_info(repo, sha)
+            if first_parent:
+                parents = parents[:1]
+            shown = True
+            if paths:
+                parents, shown = log_simplify(repo, sha, tree, parents, paths, keys)
+            if since is not None and date < since:
+                # Like git, don't look past a commit that's too old.
+                parents = []
+            if generation is None:
+                generation = GRAPH_GENERATION_INFINITY
+            ret = infos[sha] = (parents, generation, date, shown)
+        return ret
+
+    def wanted(sha):
+        _, _, date, shown = info(sha)
+        return shown and (since is None or date >= since) and (until is None or date <= until)
+
+    # Equal dates come out in the order they went in, like in git.
+    counter = itertools.count()
+
+    if order is None:
+        queue = list()
+        seen = set()
+        for sha in starts:
+            if sha not in seen:
+                seen.add(sha)
+                heappush(queue, (-info(sha)[2], next(counter), sha))
+        while queue:
+            _, _, sha = heappop(queue)
+            if wanted(sha):
+                yield sha
+            for p in info(sha)[0]:
+                if p not in seen:
+                    seen.add(p)
+                    heappush(queue, (-info(p)[2], next(counter), p))
+        return
 
+    # Children of each commit we haven't shown yet.
+    indegree = dict()
+    explore = list()
+    def explore_to(generation):
+        while explore and -explore[0][0] >= generation:
+            _, _, sha = heappop(explore)
+            for p in info(sha)[0]:
+                if p in indegree:
+                    indegree[p] += 1
+                else:
+                    indegree[p] = 1
+                    heappush(explore, (-info(p)[1], next(counter), p))
+
+    for sha in starts:
+        if sha not in indegree:
+            indegree[sha] = 0
+            heappush(explore, (-info(sha)[1], next(counter), sha))
+    explore_to(min(info(sha)[1] for sha in starts))
+
+    # --date-order shows the most recent of the commits whose children
+    # have all been shown, --topo-order the last one that became so.
+    queue = list()
+    def push(sha):
+        if order == "date":
+            heappush(queue, (-info(sha)[2], next(counter), sha))
+        else:
+            queue.append(sha)
+    def pop():
+        if order == "date":
+            return heappop(queue)[2]
+        return queue.pop()
+
+    for sha in starts:
+        if indegree[sha] == 0:
+            indegree[sha] = -1 # Queued already
+            push(sha)
+    while queue:
+        sha = pop()
+        if wanted(sha):
+            yield sha
+        for p in info(sha)[0]:
+            explore_to(info(p)[1])
+            indegree[p] -= 1
+            if indegree[p] == 0:
+                push(p)
+
+def log_date_parse(text):
+    """A date for --since and --until, as a timestamp: a timestamp
+    already, an ISO 8601 date, or something like "2 weeks ago"."""
+    from datetime import datetime, timezone
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    now = time.time()
+    if text == "now":
+        return int(now)
+    if text == "yesterday":
+        return int(now) - 86400
+
+    m = re.fullmatch(r"(\d+)\.?\s*(second|minute|hour|day|week|month|year)s?(\s+ago)?", text)
+    if m:
+        unit = { "second": 1, "minute": 60, "hour": 3600, "day": 86400,
+                 "week": 7*86400, "month": 30*86400, "year": 365*86400 }[m.group(2)]
+        return int(now) - int(m.group(1)) * unit
+
+    try:
+        date = datetime.fromisoformat(text)
+    except ValueError:
+        raise Exception(f"Unknown date {text}")
+    if date.tzinfo is None:
+        # Local time, like git.
+        return int(date.timestamp())
+    return int(date.astimezone(timezone.utc).timestamp())
+
+def log_print(repo, sha):
+    """Print commit sha like git log does by default."""
+    commit = object_read(repo, sha)
+    kvlm = commit.kvlm
+    print(f"commit {sha}")
+    parents = kvlm.get(b'parent', [])
+    if type(parents) == list and len(parents) > 1:
+        length = object_abbrev_len(repo)
+        print("Merge: " + " ".join(object_abbrev(repo, p.decode("ascii"), length) for p in parents))
+
+    # author is "Name <email> timestamp timezone"
+    author, timestamp, tz = kvlm[b'author'].decode("utf8").rsplit(" ", 2)
+    sign = -1 if tz[0] == "-" else 1
+    offset = sign * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+    date = time.gmtime(int(timestamp) + offset)
+    print(f"Author: {author}")
+    print(f"Date:   {time.strftime('%a %b', date)} {date.tm_mday} {time.strftime('%H:%M:%S %Y', date)} {tz}")
+    print()
+
+    message = kvlm[None].decode("utf8").rstrip("\n").split("\n")
+    # Skip leading blank lines.
+    while message and not message[0].strip():
+        message.pop(0)
+    for line in message:
+        print(f"    {line}")
 
-class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
-        self.mode = mode
-        self.path = path
-        self.sha = sha
 
-def tree_parse_one(raw, start=0):
-    # finding the space terminatorof mode
-    x = raw.find(b' ', start)
-    assert x-start == 5 or x-start == 6 
-    # now we should read the mode:
-    mode = raw[start:x]
-    if len(mode) ==  5:
-        # Normalize to six bytes.
-        mode = b"0" + mode
-
-    # Find the NULL terminator of the path
-    y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
-    # Read the SHA…
-    raw_sha = int.from_bytes(raw[y+1:y+21], "big")
-    # and convert it into an hex string, padded to 40 chars
-    # with zeros if needed.
-    sha = format(raw_sha, "040x")
-    return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+class GitTreeLeaf(object):
+    # Trees can have tens of thousands of leaves: no __dict__, and the
+    # path and SHA are only decoded from their raw bytes when asked for.
+    __slots__ = ("mode", "raw_path", "raw_sha", "_path", "_sha")
 
-def tree_parse(raw):
+    def __init__(self, mode, path=None, sha=None, raw_path=None, raw_sha=None):
+        self.mode = mode
+        self._path = path
+        self._sha = sha
+        self.raw_path = raw_path
+        self.raw_sha = raw_sha
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = self.raw_path.decode("utf8")
+        return self._path
+
+    @path.setter
+    def path(self, value):
+        self._path = value
+        self.raw_path = None
+
+    @property
+    def sha(self):
+        if self._sha is None:
+            self._sha = self.raw_sha.hex()
+        return self._sha
+
+    @sha.setter
+    def sha(self, value):
+        self._sha = value
+        self.raw_sha = None
+
+# An entry is "mode name\0" followed by the 20 bytes of the SHA.
+TREE_ENTRY_RE = re.compile(rb'([0-7]{5,6}) ([^\x00]*)\x00')
+
+def tree_parse_offsets(raw):
+    """Index the entries of raw: for each, the offsets of the mode, of
+    the space after it and of the NUL after the name."""
+    offsets = array("I")
+    match = TREE_ENTRY_RE.match
     pos = 0
     max = len(raw)
-    ret = list()
     while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
-
+        m = match(raw, pos)
+        if not m or m.end() + 20 > max:
+            raise Exception(f"Malformed tree entry at offset {pos}")
+        offsets.extend((pos, m.end(1), m.end(2)))
+        pos = m.end() + 20
+    return offsets
+
+def tree_leaves(raw, offsets):
+    """Build the leaves of every entry indexed in offsets."""
+    ret = list()
+    it = iter(offsets)
+    for start, space, nul in zip(it, it, it):
+        mode = raw[start:space]
+        if space - start == 5:
+            # Normalize to six bytes.
+            mode = b"0" + mode
+        # bytes() is free on bytes, and copies just the name out of a
+        # memoryview.
+        ret.append(GitTreeLeaf(bytes(mode), None, None, bytes(raw[space+1:nul]), bytes(raw[nul+1:nul+21])))
     return ret
 
+def tree_leaf_at(raw, offsets, i):
+    return tree_leaves(raw, offsets[3*i:3*i+3])[0]
 
+def tree_parse(raw):
+    return tree_leaves(raw, tree_parse_offsets(raw))
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
+    # Git sorts trees as if their name ended with a slash.
+    path = leaf.raw_path if leaf.raw_path is not None else leaf.path.encode("utf8")
+    if leaf.mode.startswith(b"04"):
+        return path + b"/"
     else:
-        return leaf.path + "/"
-    
+        return path
+
 def tree_serialize(obj):
+    if obj._items is None and obj.raw is not None:
+        # Nobody touched the leaves, the tree is still what we read.
+        return bytes(obj.raw)
+
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
+    ret = list()
     for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+        ret += [ i.mode.lstrip(b"0") if i.mode.startswith(b"04") else i.mode,
+                 b' ',
+                 i.raw_path if i.raw_path is not None else i.path.encode("utf8"),
+                 b'\x00',
+                 i.raw_sha if i.raw_sha is not None else bytes.fromhex(i.sha) ]
+    return b''.join(ret)
+
+def tree_find(tree, name):
+    """Return the leaf of tree called name, or None.  On a tree we read
+    from the store, this is a binary search on the raw entries, which
+    are sorted, and no leaf but the one we return is built."""
+    if tree._items is not None or tree.raw is None:
+        for leaf in tree.items:
+            if leaf.path == name:
+                return leaf
+        return None
+
+    raw = tree.raw
+    offsets = tree.offsets
+    target = name.encode("utf8")
+    # The name sorts differently whether it is a tree or not, so try both.
+    for key in (target, target + b"/"):
+        lo = 0
+        hi = len(offsets) // 3
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, space, nul = offsets[3*mid:3*mid+3]
+            cur = bytes(raw[space+1:nul])
+            if raw[start] == ord("4") or raw[start+1] == ord("4"):
+                cur += b"/"
+            if cur < key:
+                lo = mid + 1
+            elif cur > key:
+                hi = mid
+            else:
+                return tree_leaf_at(raw, offsets, mid)
+    return None
 
 class GitTree(GitObject):
     fmt=b'tree'
+    raw = None
+    offsets = None
+    _items = None
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self.offsets = tree_parse_offsets(data)
 
     def serialize(self):
         return tree_serialize(self)
 
+    @property
+    def items(self):
+        # Leaves are only built the first time someone wants them.
+        if self._items is None:
+            if self.raw is None:
+                self._items = list()
+            else:
+                self._items = tree_leaves(self.raw, self.offsets)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+
     def init(self):
         self.items = list()
 
@@ -599,12 +1641,23 @@ argsp.add_argument("commit",
                    help="The commit or tree to checkout.")
 
 argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+                   nargs="?",
+                   help="The EMPTY directory to checkout on.  Without it, switch the worktree to commit.")
+
+argsp.add_argument("-j",
+                   dest="jobs",
+                   type=int,
+                   default=1,
+                   help="Number of threads writing files")
 
 
 def cmd_checkout(args):
     repo = repo_find()
 
+    if args.path is None:
+        checkout(repo, args.commit, jobs=args.jobs)
+        return
+
     obj = object_read(repo, object_find(repo, args.commit))
 
     # If the object is a commit, we grab its tree
@@ -620,67 +1673,218 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
-
-def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
-
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
-
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
-
-    # Sometimes, an indirect reference may be broken.  This is normal
-    # in one specific case: we're looking for HEAD on a new repository
-    # with no commits.  In that case, .git/HEAD points to "ref:
-    # refs/heads/main", but .git/refs/heads/main doesn't exist yet
-    # (since there's no commit for it to refer to).
-    if not os.path.isfile(path):
+    tree_checkout(repo, obj, os.path.realpath(args.path), jobs=args.jobs)
+
+def tree_checkout(repo, tree, path, jobs=1):
+    """Write tree into the empty directory path.  We first create the
+    whole directory skeleton, then write the blobs."""
+    blobs = list()
+    todo = [ (tree, path) ]
+    while todo:
+        tree, path = todo.pop()
+        for item in tree.items:
+            dest = os.path.join(path, item.path)
+
+            # The mode tells us what the leaf is, no need to read it first.
+            if item.mode.startswith(b'04'):
+                os.mkdir(dest)
+                todo.append((object_read(repo, item.sha), dest))
+            elif item.mode.startswith(b'16'):
+                # A submodule: we don't have its objects, leave it empty.
+                os.mkdir(dest)
+            else:
+                blobs.append((dest, item.mode, item.sha))
+
+    checkout_blobs(repo, blobs, jobs)
+
+def checkout_blob(repo, dest, mode, sha):
+    """Write blob sha at dest, which mustn't exist: a symlink to the
+    blob's content if mode says so, else a file."""
+    if mode.startswith(b'12'):
+        os.symlink(os.fsdecode(bytes(object_read_raw(repo, sha)[1])), dest)
+        return
+    with open(dest, 'wb') as f:
+        object_read_stream(repo, sha, f)
+    if mode == b'100755':
+        # Executable by whoever can read it, umask permitting.
+        st = os.stat(dest)
+        os.chmod(dest, st.st_mode | (st.st_mode & 0o444) >> 2)
+
+def checkout_blobs(repo, blobs, jobs=1):
+    """Write every (dest, mode, sha) of blobs, with jobs threads if
+    asked to: most of the time goes into zlib and write(), which both
+    release the GIL."""
+    def write_blob(blob):
+        try:
+            checkout_blob(repo, *blob)
+        except Exception as e:
+            return blob[0], e
+
+    if jobs > 1 and len(blobs) > 1:
+        repo_packs(repo) # Load the indexes once, before the threads race to.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(write_blob, blobs)
+            errors = [ r for r in results if r ]
+    else:
+        errors = [ r for r in map(write_blob, blobs) if r ]
+
+    # Report every failure, always in the same order.
+    if errors:
+        errors.sort(key=lambda e: e[0])
+        raise Exception(f"Checkout failed for {len(errors)} file(s):\n" +
+                        "\n".join(f" - {dest}: {e}" for dest, e in errors))
+
+# References
+# ==========
+#
+# A ref lives either in its own file under .git/refs, or as a line of
+# .git/packed-refs, where git gathers them (repos with thousands of tags
+# would otherwise have thousands of tiny files).  Loose files win over
+# packed lines.  Both are cached on the GitRepo and reread only when
+# their mtime changes.
+
+def packed_refs_read(repo):
+    """Return (refs, peeled), two dicts from ref name to SHA read from
+    .git/packed-refs.  peeled holds, for annotated tags, the object the
+    tag finally points to."""
+    path = repo_path(repo, "packed-refs")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return dict(), dict()
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if repo.packed_refs and repo.packed_refs[0] == key:
+        return repo.packed_refs[1], repo.packed_refs[2]
+
+    refs = dict()
+    peeled = dict()
+    last = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                # Peeled value of the ref on the previous line
+                peeled[last] = line[1:]
+                continue
+            sha, last = line.split(" ", 1)
+            refs[last] = sha
+
+    repo.packed_refs = (key, refs, peeled)
+    return refs, peeled
+
+def ref_read_loose(repo, path):
+    """Return the content of the loose ref file at path, or None."""
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
         return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = repo.ref_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
 
     with open(path, 'r') as fp:
         data = fp.read()[:-1]
         # Drop final \n ^^^^^
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
-    
+    repo.ref_cache[path] = (key, data)
+    return data
 
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
-    ret = dict()
-    # Git shows refs sorted.  To do the same, we sort the output of
-    # listdir
-    for f in sorted(os.listdir(path)):
-        box = os.path.join(path, f)
-        if os.path.isdir(box):
-            ret[f] = ref_list(repo, box)
-        else:
-            ret[f] = ref_resolve(repo, box)
+def ref_resolve(repo, ref):
+    # Follow symbolic refs ("ref: refs/heads/master") until we reach a
+    # SHA.  Git gives up after five levels, so do we.
+    for _ in range(5):
+        data = ref_read_loose(repo, repo_path(repo, ref))
+        if data is None:
+            data = packed_refs_read(repo)[0].get(ref)
+
+        # Sometimes, an indirect reference may be broken.  This is normal
+        # in one specific case: we're looking for HEAD on a new repository
+        # with no commits.  In that case, .git/HEAD points to "ref:
+        # refs/heads/main", but .git/refs/heads/main doesn't exist yet
+        # (since there's no commit for it to refer to).
+        if data is None:
+            return None
 
+        if data.startswith("ref: "):
+            ref = data[5:]
+        else:
+            return data
+    raise Exception(f"Too many levels of symbolic refs for {ref}")
+
+def ref_list_flat(repo):
+    """Return a dict from the full name of every ref ("refs/tags/v1") to
+    its SHA, sorted by name."""
+    refs = dict(packed_refs_read(repo)[0])
+
+    # Loose refs, with scandir: no extra stat per entry.
+    todo = [ "refs" ]
+    while todo:
+        prefix = todo.pop()
+        try:
+            entries = list(os.scandir(repo_path(repo, prefix)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            name = prefix + "/" + entry.name
+            if entry.is_dir():
+                todo.append(name)
+            elif entry.is_file():
+                refs[name] = ref_resolve(repo, name)
+
+    # Git shows refs sorted.
+    return dict(sorted(refs.items()))
+
+def ref_list(repo):
+    """Same as ref_list_flat, but nested, one dict per directory under
+    refs/."""
+    ret = dict()
+    for name, sha in ref_list_flat(repo).items():
+        parts = name.split("/")[1:]
+        box = ret
+        for part in parts[:-1]:
+            box = box.setdefault(part, dict())
+        box[parts[-1]] = sha
     return ret
 
+def ref_peel(repo, ref, sha):
+    """Return what ref (whose value is sha) points to once every tag on
+    the way is followed.  packed-refs may know it already."""
+    peeled = packed_refs_read(repo)[1].get(ref)
+    if peeled:
+        return peeled
+    obj = object_read(repo, sha)
+    while obj is not None and obj.fmt == b'tag':
+        sha = obj.kvlm[b'object'].decode("ascii")
+        obj = object_read(repo, sha)
+    return sha
+
 
 argsp = argsubparsers.add_parser("show-ref", help="List references.")
+argsp.add_argument("-d", "--dereference",
+                   action="store_true",
+                   help="Also show what annotated tags point to, as <ref>^{}")
+
 def cmd_show_ref(args):
     repo = repo_find()
-    refs = ref_list(repo)
-    show_ref(repo, refs,prefix='refs')
+    for name, sha in ref_list_flat(repo).items():
+        if sha is None:
+            continue # Broken symbolic ref
+        print(f"{sha} {name}")
+        if args.dereference and name.startswith("refs/tags/"):
+            peeled = ref_peel(repo, name, sha)
+            if peeled != sha:
+                print(f"{peeled} {name}^{{}}")
 
 def show_ref(repo, refs, with_hash=True, prefix=""):
     if prefix:
         prefix += '/'
-    for key,value in refs.itme():
+    for key,value in refs.items():
         if type(value) == str and with_hash:
             print(f"{value} {prefix}{key}")
         elif type(value) == str:
@@ -689,6 +1893,56 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
             show_ref(repo, value, with_hash=with_hash, prefix=f"{prefix}{key}")
 
 
+argsp = argsubparsers.add_parser("pack-refs", help="Pack refs into .git/packed-refs.")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack every ref, not only tags")
+
+def cmd_pack_refs(args):
+    repo = repo_find()
+    refs_pack(repo, all=args.all)
+
+def refs_pack(repo, all=False):
+    """Move loose refs into packed-refs: tags only, or every ref if all.
+    Return the number of refs packed."""
+    refs, _ = packed_refs_read(repo)
+    refs = dict(refs)
+    packed = list()
+    for name in ref_list_flat(repo):
+        path = repo_path(repo, name)
+        data = ref_read_loose(repo, path)
+        if data is None or data.startswith("ref: "):
+            continue # Packed already, or symbolic (can't be packed)
+        if all or name.startswith("refs/tags/"):
+            refs[name] = data
+            packed.append(path)
+
+    lines = [ "# pack-refs with: peeled fully-peeled sorted \n" ]
+    for name in sorted(refs):
+        lines.append(f"{refs[name]} {name}\n")
+        if name.startswith("refs/tags/"):
+            peeled = ref_peel(repo, name, refs[name])
+            if peeled != refs[name]:
+                lines.append(f"^{peeled}\n")
+
+    # The lock file keeps two writers from racing, like git does.
+    path = repo_path(repo, "packed-refs")
+    with open(path + ".lock", "x") as f:
+        f.write("".join(lines))
+    os.replace(path + ".lock", path)
+
+    # The packed copies are authoritative now.
+    refs_dir = repo_path(repo, "refs")
+    for ref_path in packed:
+        os.remove(ref_path)
+        repo.ref_cache.pop(ref_path, None)
+        parent = os.path.dirname(ref_path)
+        while parent != refs_dir and os.path.dirname(parent) != refs_dir and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    return len(packed)
+
+
 # class GitTag(GitObject):
 #     fmt=b'tag'
 
@@ -738,7 +1992,7 @@ def cmd_tag(args):
         tag_creat(repo, args.name, args.object, create_tag_object = args.create_tag_object)
     else:
         refs = ref_list(repo)
-        show_ref(repo,refs["tag"], with_hash=False)
+        show_ref(repo,refs.get("tags", dict()), with_hash=False)
 
 def tag_creat(repo, name, ref, create_tag_object=False):
     
@@ -756,10 +2010,78 @@ def tag_creat(repo, name, ref, create_tag_object=False):
     else:
         ref_create(repo,"tags/"+ name, sha)
 
+def ref_write(repo, path, data):
+    """Write data to the loose ref file at path.  Through a lock file
+    renamed into place, like packed-refs: the ref gets a new inode, so
+    no cached copy of the old content can be mistaken for it."""
+    with open(path + ".lock", "x") as f:
+        f.write(data)
+    os.replace(path + ".lock", path)
+    repo.ref_cache.pop(path, None)
+
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    ref_write(repo, repo_file(repo, "refs/" + ref_name), sha + "\n")
+
+
+# Short hashes
+# ============
+#
+# To resolve a prefix we need every object whose SHA starts with it.
+# Pack indexes are sorted already, we bisect them directly.  Loose
+# objects get a sorted list per fanout directory, listed the first time
+# it's needed and kept up to date by object_write: the next lookups in
+# the same process are a bisect.
+
+def object_prefix_loose(repo, prefix):
+    """Return the loose objects whose SHA starts with prefix (at least
+    two hex digits)."""
+    shas = repo.loose_index.get(prefix[0:2])
+    if shas is None:
+        path = repo_dir(repo, "objects", prefix[0:2])
+        shas = sorted(prefix[0:2] + f for f in os.listdir(path) if len(f) == 38) if path else list()
+        repo.loose_index[prefix[0:2]] = shas
 
+    ret = list()
+    i = bisect_left(shas, prefix)
+    while i < len(shas) and shas[i].startswith(prefix):
+        ret.append(shas[i])
+        i += 1
+    return ret
+
+def object_prefix(repo, prefix):
+    """Return the SHAs of every object, loose or packed, starting with
+    prefix, sorted and without duplicates."""
+    ret = set(object_prefix_loose(repo, prefix))
+    for pack in repo_packs(repo):
+        ret.update(pack_prefix(pack, prefix))
+    return sorted(ret)
+
+def object_index_add(repo, sha):
+    """Record a new loose object, if its fanout directory was listed."""
+    shas = repo.loose_index.get(sha[0:2])
+    if shas is not None:
+        i = bisect_left(shas, sha)
+        if i == len(shas) or shas[i] != sha:
+            shas.insert(i, sha)
+
+def object_abbrev_len(repo):
+    """git's default length for short hashes: 7, or more for big
+    repositories, so that collisions stay unlikely."""
+    count = sum(pack.count for pack in repo_packs(repo))
+    # With about 2**bits objects, expect collisions at 2**(bits/2), and
+    # there are 4 bits per hex digit.
+    bits = count.bit_length()
+    return max(7, (bits + 1) // 2)
+
+def object_abbrev(repo, sha, length=None):
+    """The shortest prefix of sha, at least length (the default one if
+    None), that names no other object."""
+    length = length or object_abbrev_len(repo)
+    while length < 40 and len(object_prefix(repo, sha[:length])) > 1:
+        length += 1
+    return sha[:length]
+
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
 def object_resolve(repo, name):
     """Resolve name to an object hash in repo.
@@ -773,29 +2095,18 @@ This function is aware of:
     - remote branches"""
 
     candidates = list()
-    hashRE= re.compile(r"^[0-9A-Fa-f]{4,40}$")
     # If it is an empty string, abort!
-    if name.strip() == None:
+    if not name.strip():
         return None
     
     if name == 'HEAD':
         return [ref_resolve(repo, "HEAD")]
     
-    if hashRE.match(name):
+    if HASH_RE.match(name):
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         # This limit is documented in man git-rev-parse
-
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "object",mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f) 
+        candidates += object_prefix(repo, name.lower())
     
      # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -810,7 +2121,8 @@ This function is aware of:
     if as_remote_branch: # Did we find a remote branch?
         candidates.append(as_remote_branch)
 
-    return candidates        
+    # A branch and a short hash may well name the same object.
+    return list(dict.fromkeys(candidates))
 
 
 argsp = argsubparsers.add_parser(
@@ -846,10 +2158,17 @@ def cmd_rev_parse(args):
 # None 
 
 class GitIndexEntry(object):
+    # Indexes can have hundreds of thousands of entries: no __dict__.
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "name", "flag_skip_worktree",
+                 "flag_intent_to_add", "uptodate")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, flag_skip_worktree=False,
+                 flag_intent_to_add=False, uptodate=False):
         # The last time a file's metadata changed.  This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -877,20 +2196,82 @@ class GitIndexEntry(object):
         self.flag_stage = flag_stage
         # Name of the object (full path this time!)
         self.name = name
+        # Extended flags, only in version 3 and up.
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
+        # Not stored: the file was checked against sha by this process,
+        # so index_write() needn't look at it again even if it's racy.
+        self.uptodate = uptodate
 
 
     
 class GitIndex(object):
     version = None
     entries = []
-    # ext, sha = None, None
-    def __init__(self, version=2, entries=None):
+    # The TREE extension, a GitCacheTree, or None.
+    cache_tree = None
+    # mtime of the index file when we read it, in nanoseconds.  Entries
+    # modified at or after it are "racy", see index_entry_changed().
+    timestamp = None
+
+    def __init__(self, version=2, entries=None, cache_tree=None, timestamp=None):
         if not entries:
             entries = list()
 
         self.version = version
         self.entries = entries
+        self.cache_tree = cache_tree
+        self.timestamp = timestamp
+
+class GitCacheTree(object):
+    """A node of the TREE extension: the tree object for a directory of
+    the index, so that writing a tree doesn't have to rehash directories
+    that didn't change.  entry_count is the number of index entries
+    under the directory, or -1 if the node was invalidated, in which
+    case sha is None."""
+    __slots__ = ("name", "entry_count", "sha", "subtrees")
+
+    def __init__(self, name="", entry_count=-1, sha=None, subtrees=None):
+        self.name = name
+        self.entry_count = entry_count
+        self.sha = sha
+        self.subtrees = subtrees if subtrees is not None else list()
+
+    def subtree(self, name, create=False):
+        for sub in self.subtrees:
+            if sub.name == name:
+                return sub
+        if create:
+            sub = GitCacheTree(name)
+            self.subtrees.append(sub)
+            return sub
+        return None
+
 
+# The fixed part of an index entry, 62 bytes: ctime (seconds,
+# nanoseconds), mtime (same), dev, ino, mode (the upper 16 bits are
+# unused), uid, gid, size, SHA and flags.
+INDEX_ENTRY = struct.Struct(">LLLLLLLLLL20sH")
+
+INDEX_FLAG_ASSUME_VALID  = 0b1000000000000000
+INDEX_FLAG_EXTENDED      = 0b0100000000000000
+INDEX_FLAG_STAGE         = 0b0011000000000000
+INDEX_FLAG_NAME_LENGTH   = 0b0000111111111111
+# Version 3 extended flags
+INDEX_FLAG_SKIP_WORKTREE = 0b0100000000000000
+INDEX_FLAG_INTENT_TO_ADD = 0b0010000000000000
+
+def index_varint_decode(raw, pos):
+    """Version 4 path compression uses the same varint as OFS_DELTA
+    offsets in packs."""
+    c = raw[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = raw[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
 
 def index_read(repo):
     index_file = repo_file(repo, "index")
@@ -901,103 +2282,290 @@ def index_read(repo):
 
     with open(index_file, 'rb') as f:
         raw = f.read()
+        timestamp = os.fstat(f.fileno()).st_mtime_ns
 
     header = raw[:12]
     signature = header[:4]
     assert signature == b"DIRC" # Stands for "DirCache"
     version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
+    if version not in (2, 3, 4):
+        raise Exception(f"Unsupported index version {version}")
     count = int.from_bytes(header[8:12], "big")
 
+    # The last 20 bytes are the SHA-1 of everything before them.
+    if hashlib.sha1(memoryview(raw)[:-20]).digest() != raw[-20:]:
+        raise Exception("Corrupt index: bad checksum")
+
     entries = list()
+    unpack = INDEX_ENTRY.unpack_from
+    previous_name = b""
 
-    content = raw[12:]
-    idx = 0
+    idx = 12
     for i in range(0,count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
+        start = idx
+        # Everything but the name, in one go.
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = unpack(raw, idx)
+        idx += 62
+
         mode_type = mode >> 12
         assert mode_type in [0b1000, 0b1010, 0b1110]
         mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
         #Parsa flags
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
-        flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
-        # Length of the name.  This is stored on 12 bits, some max value is 0xFFF, 4095.  Since names can occasionally go
-        # beyond that length, git treats 0xFFF as meaning at least 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance cost.
-        name_length = flags & 0b0000111111111111
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
+        flag_assume_valid = (flags & INDEX_FLAG_ASSUME_VALID) != 0
+        flag_stage =  flags & INDEX_FLAG_STAGE
+
+        flag_skip_worktree = flag_intent_to_add = False
+        if flags & INDEX_FLAG_EXTENDED:
+            if version < 3:
+                raise Exception("Extended flags in a version 2 index")
+            extended = int.from_bytes(raw[idx:idx+2], "big")
+            flag_skip_worktree = (extended & INDEX_FLAG_SKIP_WORKTREE) != 0
+            flag_intent_to_add = (extended & INDEX_FLAG_INTENT_TO_ADD) != 0
+            idx += 2
+
+        if version == 4:
+            # The name is the previous one, minus as many bytes at its
+            # end as the varint says, plus the NUL-terminated suffix.
+            strip, idx = index_varint_decode(raw, idx)
+            end = raw.index(b'\x00', idx)
+            raw_name = previous_name[:len(previous_name)-strip] + raw[idx:end]
+            idx = end + 1
+            previous_name = raw_name
         else:
-            print(f"Notice: Name is 0x{name_length:X} bytes long.")
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
+            # Length of the name.  This is stored on 12 bits, some max value is 0xFFF, 4095.  Since names can occasionally go
+            # beyond that length, git treats 0xFFF as meaning at least 0xFFF, and looks for the final 0x00 to find the end of the
+            # name --- at a small, and probably very rare, performance cost.
+            name_length = flags & INDEX_FLAG_NAME_LENGTH
+            if name_length < 0xFFF:
+                assert raw[idx + name_length] == 0x00
+                raw_name = raw[idx:idx+name_length]
+            else:
+                raw_name = raw[idx:raw.index(b'\x00', idx + 0xFFF)]
+
+            # Data is padded on multiples of eight bytes for pointer
+            # alignment, so we skip as many bytes as we need for the next
+            # read to start at the right position.  (The 12 bytes header
+            # is not part of the alignment.)
+            idx = start + ((idx - start + len(raw_name) + 8) & ~7)
 
         # Just parse the name as utf8.
         name = raw_name.decode("utf8")
 
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
+        # Positional arguments: keywords cost a lot over 100k entries.
+        entries.append(GitIndexEntry((ctime_s, ctime_ns), (mtime_s,  mtime_ns),
+                                     dev, ino, mode_type, mode_perms,
+                                     uid, gid, fsize, sha.hex(),
+                                     flag_assume_valid, flag_stage, name,
+                                     flag_skip_worktree, flag_intent_to_add))
+
+    # Extensions: 4 bytes signature, 4 bytes size, data.
+    cache_tree = None
+    end = len(raw) - 20
+    while idx < end:
+        ext = raw[idx:idx+4]
+        size = int.from_bytes(raw[idx+4:idx+8], "big")
+        data = raw[idx+8:idx+8+size]
+        idx += 8 + size
+        if ext == b"TREE":
+            cache_tree = cache_tree_parse(data)
+        elif not (b"A" <= ext[0:1] <= b"Z"):
+            # Extensions starting with an uppercase letter are optional
+            # and can be ignored (UNTR, FSMN...), the others can't.
+            raise Exception(f"Unsupported index extension {ext}")
+
+    return GitIndex(version=version, entries=entries, cache_tree=cache_tree, timestamp=timestamp)
+
+def cache_tree_parse(data):
+    """Parse the TREE extension.  Nodes are stored depth first: the
+    name (the root's is empty), NUL, the entry count and the number of
+    subtrees in ASCII, a newline, then the SHA unless the entry count
+    is -1."""
+    root = None
+    # Nodes still waiting for some of their subtrees: [node, missing]
+    stack = list()
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b'\x00', pos)
+        nl = data.index(b'\n', nul)
+        name = data[pos:nul].decode("utf8")
+        entry_count, subtree_count = (int(x) for x in data[nul+1:nl].split(b' '))
+        pos = nl + 1
+        sha = None
+        if entry_count >= 0:
+            sha = data[pos:pos+20].hex()
+            pos += 20
+
+        node = GitCacheTree(name, entry_count, sha)
+        if stack:
+            stack[-1][0].subtrees.append(node)
+            stack[-1][1] -= 1
+        else:
+            root = node
+        stack.append([node, subtree_count])
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    return root
 
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
+def cache_tree_serialize(root):
+    ret = list()
+    stack = [ root ]
+    while stack:
+        node = stack.pop()
+        ret += [ node.name.encode("utf8"), b'\x00',
+                 f"{node.entry_count} {len(node.subtrees)}\n".encode("ascii") ]
+        if node.entry_count >= 0:
+            ret.append(bytes.fromhex(node.sha))
+        stack += reversed(node.subtrees)
+    return b''.join(ret)
+
+def cache_tree_invalidate(index, path):
+    """Mark every directory containing path as changed."""
+    node = index.cache_tree
+    if node is None:
+        return
+    parts = path.split("/")
+    for part in [ None ] + parts[:-1]:
+        if part is not None:
+            node = node.subtree(part)
+            if node is None:
+                return
+        node.entry_count = -1
+        node.sha = None
+
+def index_write(repo, index):
+    """Write index to .git/index, followed by the SHA-1 of its content.
+    We write to index.lock first and rename it, like git."""
+    version = index.version
+    if version == 2 and any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries):
+        version = 3 # Extended flags need version 3
+
+    ret = [ b"DIRC", struct.pack(">LL", version, len(index.entries)) ]
+    pack = INDEX_ENTRY.pack
+    previous_name = b""
 
-    return GitIndex(version=version, entries=entries)
+    for e in index.entries:
+        if not e.uptodate and index_entry_racy(index, e) \
+           and e.fsize and index_entry_changed(repo, index, e):
+            # The file changed after we recorded it, but too fast for its
+            # stat data to show it.  Once this index is written with a
+            # newer mtime, nothing would tell us to look at the file
+            # again: clear the size so that it doesn't match anymore.
+            e.fsize = 0
+        raw_name = e.name.encode("utf8")
+        flags = min(len(raw_name), 0xFFF) | e.flag_stage
+        if e.flag_assume_valid:
+            flags |= INDEX_FLAG_ASSUME_VALID
+        extended = 0
+        if e.flag_skip_worktree:
+            extended |= INDEX_FLAG_SKIP_WORKTREE
+        if e.flag_intent_to_add:
+            extended |= INDEX_FLAG_INTENT_TO_ADD
+        if extended:
+            flags |= INDEX_FLAG_EXTENDED
+
+        entry = [ pack(e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1],
+                       e.dev, e.ino, (e.mode_type << 12) | e.mode_perms,
+                       e.uid, e.gid, e.fsize, bytes.fromhex(e.sha), flags) ]
+        if extended:
+            entry.append(extended.to_bytes(2, "big"))
+        fixed = 64 if extended else 62
+
+        if version == 4:
+            # Only store what differs from the previous name.
+            common = 0
+            for a, b in zip(previous_name, raw_name):
+                if a != b:
+                    break
+                common += 1
+            # The varint encoding is the one of OFS_DELTA offsets.
+            entry += [ pack_encode_ofs(len(previous_name) - common), raw_name[common:], b"\x00" ]
+            previous_name = raw_name
+        else:
+            # Padding: at least one NUL ends the name, then as many as it
+            # takes to reach a multiple of eight bytes.
+            padding = ((fixed + len(raw_name) + 8) & ~7) - fixed - len(raw_name)
+            entry += [ raw_name, b"\x00" * padding ]
+        ret += entry
+
+    if index.cache_tree is not None:
+        tree = cache_tree_serialize(index.cache_tree)
+        ret += [ b"TREE", struct.pack(">L", len(tree)), tree ]
+
+    data = b''.join(ret)
+    path = repo_file(repo, "index")
+    with open(path + ".lock", "wb") as f:
+        f.write(data)
+        f.write(hashlib.sha1(data).digest())
+    os.replace(path + ".lock", path)
+
+def index_entry_mode(e):
+    """The tree mode of an index entry, e.g. b"100644"."""
+    perms = e.mode_perms
+    if e.mode_type == 0b1000:
+        perms = 0o755 if perms & 0o100 else 0o644
+    return f"{e.mode_type:02o}{perms:04o}".encode("ascii")
+
+def tree_from_index(repo, index):
+    """Write the trees for the content of index and return the SHA of
+    the root one.  Directories whose TREE extension node is still valid
+    are not rebuilt at all; the others get their node refreshed."""
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+    entries = [ e for e in index.entries if not e.flag_intent_to_add ]
+    for e in entries:
+        if e.flag_stage:
+            raise Exception(f"Cannot write a tree with unmerged path {e.name}")
+
+    def build(node, start, prefix):
+        if node.entry_count >= 0:
+            # Unchanged since the last time: reuse it.
+            return node.sha, start + node.entry_count
+
+        leaves = list()
+        subtrees = list()
+        i = start
+        while i < len(entries) and entries[i].name.startswith(prefix):
+            rest = entries[i].name[len(prefix):]
+            if "/" in rest:
+                name = rest[:rest.index("/")]
+                sub = node.subtree(name, create=True)
+                sha, i = build(sub, i, prefix + name + "/")
+                leaves.append(GitTreeLeaf(b"040000", name, sha))
+                subtrees.append(sub)
+            else:
+                leaves.append(GitTreeLeaf(index_entry_mode(entries[i]), rest, entries[i].sha))
+                i += 1
+
+        tree = GitTree()
+        tree.items = leaves
+        node.sha = object_write(tree, repo)
+        node.entry_count = i - start
+        # Forget subtrees of directories which don't exist anymore.
+        node.subtrees = subtrees
+        return node.sha, i
+
+    return build(index.cache_tree, 0, "")[0]
+
+
+argsp = argsubparsers.add_parser("write-tree", help="Create a tree object from the index.")
+
+def cmd_write_tree(args):
+    repo = repo_find()
+    index = index_read(repo)
+    print(tree_from_index(repo, index))
+    # Save the refreshed TREE extension for next time.
+    index_write(repo, index)
 
 
 argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
 argsp.add_argument("--verbose", action="store_true", help="Show everything.")
 
 def cmd_ls_files(args):
+    # Only --verbose needs these.
+    from datetime import datetime
+    import grp, pwd # to read the users/group database on Unix
+
     repo = repo_find()
     index = index_read(repo)
     if args.verbose:
@@ -1014,7 +2582,2298 @@ def cmd_ls_files(args):
             print(f"  created: {datetime.fromtimestamp(e.ctime[0])}.{e.ctime[1]}, modified: {datetime.fromtimestamp(e.mtime[0])}.{e.mtime[1]}")
             print(f"  device: {e.dev}, inode: {e.ino}")
             print(f"  user: {pwd.getpwuid(e.uid).pw_name} ({e.uid})  group: {grp.getgrgid(e.gid).gr_name} ({e.gid})")
-            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}")
+            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid} skip_worktree={e.flag_skip_worktree} intent_to_add={e.flag_intent_to_add}")
+
+
+
+
+# Packing loose objects
+# =====================
+#
+# gc gathers every loose object into a single new pack.  To find good
+# delta bases we do what git does: sort objects by type, then by a hash
+# of their path (so that successive versions of the same file end up
+# next to each other), then by decreasing size, and try to delta each
+# object against the previous few ones in that order (the "window").
+
+def loose_objects(repo):
+    """Yield (sha, path) for every loose object in repo."""
+    path = repo_dir(repo, "objects")
+    if not path:
+        return
+    for d in sorted(os.listdir(path)):
+        if len(d) != 2 or not os.path.isdir(os.path.join(path, d)):
+            continue
+        for f in sorted(os.listdir(os.path.join(path, d))):
+            if len(f) == 38:
+                yield d + f, os.path.join(path, d, f)
+
+def loose_object_header(path):
+    """Return (fmt, size) of a loose object, inflating only its header."""
+    with open(path, "rb") as f:
+        head = zlib.decompressobj().decompress(f.read(4096), 64)
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    return head[0:x], int(head[x+1:y].decode("ascii"))
+
+def pack_name_hash(name):
+    """Git's path hash: the last characters of a path weigh the most, so
+    files with the same name (or extension) sort close together."""
+    hash = 0
+    for c in name.encode("utf8"):
+        if c in b" \t\n\r":
+            continue
+        hash = (hash >> 2) + (c << 24)
+    return hash & 0xffffffff
+
+# Deltas match "lines", ending either on a newline or on a NUL.  The
+# latter gives us usable chunks in trees, where each entry's name ends
+# on a NUL.
+DELTA_LINE_RE = re.compile(rb'[^\n\x00]*[\n\x00]|[^\n\x00]+')
+
+def delta_index(lines):
+    """Map each line (see DELTA_LINE_RE) to the offset of its first
+    occurrence."""
+    index = dict()
+    offset = 0
+    for line in lines:
+        index.setdefault(line, offset)
+        offset += len(line)
+    return index
+
+def delta_encode_size(size):
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+def delta_create(index, base, target, lines=None, limit=None):
+    """Build a git delta turning base into target.  Matching is done
+    line by line using index, the result of delta_index() on base: cheap
+    enough in Python and good for the text files that make up most
+    repositories.  Consecutive matching lines are merged into a single
+    copy instruction.  Return None if the delta would be bigger than
+    limit."""
+    if lines is None:
+        lines = DELTA_LINE_RE.findall(target)
+    if limit is None:
+        limit = len(target)
+
+    out = delta_encode_size(len(base)) + delta_encode_size(len(target))
+    insert = bytearray()
+    copy_offset = 0
+    copy_size = 0
+
+    def flush_insert():
+        for i in range(0, len(insert), 127):
+            chunk = insert[i:i+127]
+            out.append(len(chunk))
+            out.extend(chunk)
+        insert.clear()
+
+    def flush_copy(offset, size):
+        while size:
+            n = min(size, 0x10000)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (offset >> (8*i)) & 0xff
+                if byte:
+                    op |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = ((n & 0xffff) >> (8*i)) & 0xff
+                if byte:
+                    op |= 1 << (4+i)
+                    args.append(byte)
+            out.append(op)
+            out.extend(args)
+            offset += n
+            size -= n
+
+    def end_copy(offset, size):
+        # A copy instruction costs up to 8 bytes, short matches are
+        # cheaper inserted.
+        if size < 8:
+            insert.extend(base[offset:offset+size])
+        else:
+            flush_insert()
+            flush_copy(offset, size)
+
+    for line in lines:
+        if copy_size and base.startswith(line, copy_offset + copy_size):
+            # The current copy goes on.
+            copy_size += len(line)
+            continue
+
+        if copy_size:
+            end_copy(copy_offset, copy_size)
+            copy_size = 0
+            if len(out) + len(insert) > limit:
+                return None
+        offset = index.get(line)
+        if offset is None:
+            insert += line
+        else:
+            copy_offset, copy_size = offset, len(line)
+
+    if copy_size:
+        end_copy(copy_offset, copy_size)
+    flush_insert()
+    if len(out) > limit:
+        return None
+    return bytes(out)
+
+def pack_encode_entry_header(type, size):
+    ret = bytearray()
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+def pack_encode_ofs(distance):
+    """Inverse of the base distance decoding in pack_read."""
+    ret = [ distance & 0x7f ]
+    distance >>= 7
+    while distance:
+        distance -= 1
+        ret.append(0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(reversed(ret))
+
+def pack_write(repo, objects, window=10, depth=50):
+    """Write the loose objects (a list of (sha, path) pairs) into a new
+    pack and its index.  Return (pack path, number of deltas)."""
+    pack_types = { fmt: type for type, fmt in PACK_TYPES.items() }
+
+    # First pass: type, size and a path hint for every object.  Trees
+    # give us the names of their children.
+    names = dict()
+    infos = list()
+    for sha, path in objects:
+        fmt, size = loose_object_header(path)
+        if fmt == b'tree':
+            for leaf in tree_parse(object_read_raw(repo, sha)[1]):
+                names.setdefault(leaf.sha, leaf.path)
+        infos.append((sha, fmt, size))
+    infos.sort(key=lambda i: (pack_types[i[1]], pack_name_hash(names.get(i[0], "")), -i[2]))
+
+    big_file = config_size(repo.conf.get("core", "bigfilethreshold", fallback="512m"))
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(pack_dir, f"tmp_pack_{os.getpid()}")
+    checksum = hashlib.sha1()
+    entries = list() # (binsha, crc32, offset)
+    deltas = 0
+    # The window holds (fmt, data, delta index, offset, depth)
+    recent = list()
+
+    with open(tmp_path, "wb") as f:
+        header = b"PACK" + struct.pack(">II", 2, len(infos))
+        f.write(header)
+        checksum.update(header)
+        offset = len(header)
+
+        for sha, fmt, size in infos:
+            # The delta search needs bytes methods (startswith...).
+            data = bytes(object_read_raw(repo, sha)[1])
+
+            if size > big_file:
+                # Never deltify huge blobs, so that they can always be
+                # streamed out of the pack (see object_read_stream).
+                entry = pack_encode_entry_header(pack_types[fmt], len(data)) + zlib.compress(data)
+                f.write(entry)
+                checksum.update(entry)
+                entries.append((bytes.fromhex(sha), zlib.crc32(entry), offset))
+                offset += len(entry)
+                continue
+
+            lines = DELTA_LINE_RE.findall(data)
+            best = None
+            if size >= 64:
+                for base_fmt, base, index, base_offset, base_depth in recent:
+                    if base_fmt != fmt or base_depth >= depth or len(base) < size // 32:
+                        continue
+                    limit = len(best[0]) - 1 if best else size // 2
+                    delta = delta_create(index, base, data, lines=lines, limit=limit)
+                    if delta is not None:
+                        best = (delta, base_offset, base_depth)
+
+            if best:
+                delta, base_offset, base_depth = best
+                entry = pack_encode_entry_header(PACK_OFS_DELTA, len(delta)) \
+                    + pack_encode_ofs(offset - base_offset) \
+                    + zlib.compress(delta)
+                my_depth = base_depth + 1
+                deltas += 1
+            else:
+                entry = pack_encode_entry_header(pack_types[fmt], len(data)) + zlib.compress(data)
+                my_depth = 0
+
+            f.write(entry)
+            checksum.update(entry)
+            entries.append((bytes.fromhex(sha), zlib.crc32(entry), offset))
+
+            recent.append((fmt, data, delta_index(lines), offset, my_depth))
+            if len(recent) > window:
+                recent.pop(0)
+            offset += len(entry)
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+
+    # The index: fanout, SHAs, CRCs, offsets, 64 bit offsets, checksums.
+    entries.sort()
+    fanout = [0] * 256
+    for binsha, crc, offset in entries:
+        fanout[binsha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    large_offsets = list()
+    small_offsets = list()
+    for binsha, crc, offset in entries:
+        if offset < 0x80000000:
+            small_offsets.append(offset)
+        else:
+            small_offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+
+    idx = bytearray(b"\377tOc" + struct.pack(">I", 2))
+    idx += struct.pack(">256I", *fanout)
+    idx += b''.join(e[0] for e in entries)
+    idx += struct.pack(f">{len(entries)}I", *[ e[1] for e in entries ])
+    idx += struct.pack(f">{len(entries)}I", *small_offsets)
+    idx += struct.pack(f">{len(large_offsets)}Q", *large_offsets)
+    idx += pack_sha
+    idx += hashlib.sha1(idx).digest()
+
+    # Move the pack in place before writing its index: readers only
+    # look for packs which have an .idx.
+    name = os.path.join(pack_dir, f"pack-{pack_sha.hex()}")
+    os.replace(tmp_path, name + ".pack")
+    with open(name + ".idx.tmp", "wb") as f:
+        f.write(idx)
+    os.replace(name + ".idx.tmp", name + ".idx")
+
+    repo.packs = None
+    return name + ".pack", deltas
+
+
+argsp = argsubparsers.add_parser("gc", help="Pack loose objects.")
+argsp.add_argument("--window",
+                   type=int,
+                   default=10,
+                   help="Number of objects to consider as delta bases")
+argsp.add_argument("--depth",
+                   type=int,
+                   default=50,
+                   help="Maximum length of a delta chain")
+
+def cmd_gc(args):
+    repo = repo_find()
+    gc(repo, window=args.window, depth=args.depth)
+
+def gc(repo, window=10, depth=50):
+    objects = list(loose_objects(repo))
+    if objects:
+        gc_pack(repo, objects, window, depth)
+    else:
+        print("Nothing to pack.")
+
+    count = refs_pack(repo, all=True)
+    print(f"Packed {count} refs")
+
+    count = commit_graph_write(repo)
+    print(f"Wrote commit-graph with {count} commits")
+
+def gc_pack(repo, objects, window, depth):
+    loose_size = sum(os.path.getsize(path) for sha, path in objects)
+    start = time.perf_counter()
+    pack_path, deltas = pack_write(repo, objects, window=window, depth=depth)
+    elapsed = time.perf_counter() - start
+    pack_size = os.path.getsize(pack_path)
+
+    # Everything is safely in the pack: drop the loose copies.
+    for sha, path in objects:
+        os.remove(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass # Not empty yet
+    repo.loose_index = dict()
+
+    print(f"Packed {len(objects)} objects ({deltas} deltas) in {elapsed:.2f}s, {len(objects)/max(elapsed, 1e-9):.0f} objects/s")
+    print(f"Loose: {loose_size} bytes, pack: {pack_size} bytes, ratio {pack_size/loose_size:.2f}")
+
+
+# Commit-graph
+# ============
+#
+# Walking history means reading and parsing every commit just to find
+# its parents.  Git caches the shape of the history in
+# .git/objects/info/commit-graph, and so do we, in the same format:
+#
+#   "CGPH", version 1, hash version 1 (SHA-1), number of chunks, 0
+#   chunk table: (4-byte id, 8-byte offset) per chunk, then a 0 id
+#   OIDF: 256-entry fanout table, like pack indexes
+#   OIDL: sorted 20-byte commit SHAs
+#   CDAT: for each commit, its tree SHA, the positions of its first two
+#         parents, then 30 bits of generation and 34 bits of date
+#   EDGE: extra parents of octopus merges
+#   BIDX, BDAT: optional changed-path Bloom filters, see "Path-limited
+#         history"
+#   checksum
+#
+# A commit's generation is 1 + the highest generation of its parents,
+# so roots have generation 1.
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+# Commits not in the graph: higher than any generation in it.
+GRAPH_GENERATION_INFINITY = 0xFFFFFFFF
+
+class GitCommitGraph(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, hash_version, chunks = struct.unpack_from(">4sBBB", self.data, 0)
+        if signature != b"CGPH" or version != 1 or hash_version != 1:
+            raise Exception(f"Unsupported commit-graph {path}")
+
+        self.chunks = dict()
+        for i in range(chunks):
+            id, offset = struct.unpack_from(">4sQ", self.data, 8 + 12*i)
+            self.chunks[id] = offset
+
+        self.fanout = struct.unpack_from(">256I", self.data, self.chunks[b"OIDF"])
+        self.count = self.fanout[255]
+
+def commit_graph_load(repo):
+    """Return the repository's commit-graph, or None if it doesn't have
+    one.  It is loaded once per GitRepo."""
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if os.path.isfile(path) else False
+    return repo.commit_graph or None
+
+def commit_graph_sha(graph, pos):
+    offset = graph.chunks[b"OIDL"] + 20*pos
+    return graph.data[offset:offset+20].hex()
+
+def commit_graph_find(graph, sha):
+    """Return the position of commit sha in the graph, or None."""
+    binsha = bytes.fromhex(sha)
+    lo = graph.fanout[binsha[0]-1] if binsha[0] else 0
+    hi = graph.fanout[binsha[0]]
+    base = graph.chunks[b"OIDL"]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        cur = graph.data[base + 20*mid:base + 20*mid + 20]
+        if cur < binsha:
+            lo = mid + 1
+        elif cur > binsha:
+            hi = mid
+        else:
+            return mid
+    return None
+
+def commit_graph_entry(graph, pos):
+    """Return (tree, parents, generation, date) for the commit at pos."""
+    offset = graph.chunks[b"CDAT"] + 36*pos
+    tree = graph.data[offset:offset+20].hex()
+    p1, p2, gen_date_hi, date_lo = struct.unpack_from(">IIII", graph.data, offset+20)
+
+    parents = list()
+    if p1 != GRAPH_PARENT_NONE:
+        parents.append(commit_graph_sha(graph, p1))
+    if p2 & GRAPH_EXTRA_EDGES:
+        edges = graph.chunks[b"EDGE"] + 4*(p2 & ~GRAPH_EXTRA_EDGES)
+        while True:
+            edge = struct.unpack_from(">I", graph.data, edges)[0]
+            parents.append(commit_graph_sha(graph, edge & ~GRAPH_LAST_EDGE))
+            if edge & GRAPH_LAST_EDGE:
+                break
+            edges += 4
+    elif p2 != GRAPH_PARENT_NONE:
+        parents.append(commit_graph_sha(graph, p2))
+
+    generation = gen_date_hi >> 2
+    date = ((gen_date_hi & 0b11) << 32) | date_lo
+    return tree, parents, generation, date
+
+def commit_info(repo, sha):
+    """Return (tree, parents, generation, date) of commit sha, from the
+    commit-graph if it has it.  Otherwise the commit is parsed, and
+    generation is None."""
+    graph = commit_graph_load(repo)
+    if graph:
+        pos = commit_graph_find(graph, sha)
+        if pos is not None:
+            return commit_graph_entry(graph, pos)
+
+    commit = object_read(repo, sha)
+    parents = commit.kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [ parents ]
+    # committer is "Name <email> timestamp timezone"
+    date = int(commit.kvlm[b'committer'].split(b' ')[-2])
+    return (commit.kvlm[b'tree'].decode("ascii"),
+            [ p.decode("ascii") for p in parents ],
+            None,
+            date)
+
+def commit_parents(repo, sha):
+    return commit_info(repo, sha)[1]
+
+def ref_list_shas(refs):
+    """Flatten the output of ref_list into a list of SHAs."""
+    ret = list()
+    for value in refs.values():
+        if type(value) == str:
+            ret.append(value)
+        elif value:
+            ret += ref_list_shas(value)
+    return ret
+
+def commit_graph_write(repo, changed_paths=False):
+    """Write a commit-graph of every commit reachable from the refs and
+    HEAD, with changed-path Bloom filters if asked to.  Return the
+    number of commits in it."""
+    # Gather the commits, peeling tags on the way.
+    commits = dict() # sha -> (tree, parents, date)
+    todo = ref_list_shas(ref_list(repo))
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        todo.append(head)
+    while todo:
+        sha = todo.pop()
+        if sha in commits:
+            continue
+        obj = object_read(repo, sha)
+        if obj is None:
+            continue
+        if obj.fmt == b'tag':
+            todo.append(obj.kvlm[b'object'].decode("ascii"))
+            continue
+        if obj.fmt != b'commit':
+            continue
+        tree, parents, _, date = commit_info(repo, sha)
+        commits[sha] = (tree, parents, date)
+        todo += parents
+
+    # Generations, computed parents first without recursing.
+    generation = dict()
+    for sha in commits:
+        stack = [ sha ]
+        while stack:
+            cur = stack[-1]
+            if cur in generation:
+                stack.pop()
+                continue
+            missing = [ p for p in commits[cur][1] if p not in generation ]
+            if missing:
+                stack += missing
+            else:
+                generation[cur] = 1 + max((generation[p] for p in commits[cur][1]), default=0)
+                stack.pop()
+
+    shas = sorted(commits)
+    position = { sha: i for i, sha in enumerate(shas) }
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    cdat = bytearray()
+    edge = list()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        p1 = position[parents[0]] if parents else GRAPH_PARENT_NONE
+        if len(parents) > 2:
+            p2 = GRAPH_EXTRA_EDGES | len(edge)
+            edge += [ position[p] for p in parents[1:] ]
+            edge[-1] |= GRAPH_LAST_EDGE
+        elif len(parents) == 2:
+            p2 = position[parents[1]]
+        else:
+            p2 = GRAPH_PARENT_NONE
+        gen = min(generation[sha], 0x3fffffff)
+        cdat += bytes.fromhex(tree)
+        cdat += struct.pack(">IIII", p1, p2, (gen << 2) | (date >> 32 & 0b11), date & 0xffffffff)
+
+    chunks = [ (b"OIDF", struct.pack(">256I", *fanout)),
+               (b"OIDL", b''.join(bytes.fromhex(sha) for sha in shas)),
+               (b"CDAT", bytes(cdat)) ]
+    if edge:
+        chunks.append((b"EDGE", struct.pack(f">{len(edge)}I", *edge)))
+    if changed_paths:
+        bidx = list()
+        bdat = [ struct.pack(">III", BLOOM_VERSION, BLOOM_HASHES, BLOOM_BITS_PER_ENTRY) ]
+        end = 0
+        for sha in shas:
+            tree, parents, _ = commits[sha]
+            bloom = bloom_filter_compute(repo, commits[parents[0]][0] if parents else None, tree)
+            end += len(bloom)
+            bidx.append(end)
+            bdat.append(bloom)
+        chunks.append((b"BIDX", struct.pack(f">{len(bidx)}I", *bidx)))
+        chunks.append((b"BDAT", b"".join(bdat)))
+
+    out = bytearray(b"CGPH" + struct.pack(">BBBB", 1, 1, len(chunks), 0))
+    offset = len(out) + 12 * (len(chunks) + 1)
+    for id, data in chunks:
+        out += id + struct.pack(">Q", offset)
+        offset += len(data)
+    out += b"\0\0\0\0" + struct.pack(">Q", offset)
+    for id, data in chunks:
+        out += data
+    out += hashlib.sha1(out).digest()
+
+    path = repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(out)
+    os.replace(path + ".tmp", path)
+    repo.commit_graph = None
+    return len(shas)
+
+
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file.")
+argsp.add_argument("action",
+                   choices=["write"],
+                   help="What to do with the commit-graph")
+
+argsp.add_argument("--changed-paths",
+                   action="store_true",
+                   help="Also write changed-path Bloom filters, for log -- <path>")
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+    count = commit_graph_write(repo, changed_paths=args.changed_paths)
+    print(f"Wrote commit-graph with {count} commits")
+
+
+# Status
+# ======
+#
+# Hashing every file of the worktree is what makes a naive status slow.
+# The index remembers the stat data of every file when it was staged:
+# if it's still the same, the file is assumed unchanged, and only the
+# others get hashed.  The catch is "racy git": a file modified in the
+# same instant the index was written has the same mtime as before, so
+# any entry whose mtime isn't older than the index file is checked by
+# content.
+
+def index_entry_from_stat(name, sha, st):
+    """An entry for a file with stat data st that was just hashed to (or
+    written from) sha."""
+    if stat.S_ISLNK(st.st_mode):
+        mode_type, mode_perms = 0b1010, 0
+    else:
+        mode_type = 0b1000
+        mode_perms = 0o755 if st.st_mode & 0o100 else 0o644
+    return GitIndexEntry(divmod(st.st_ctime_ns, 10**9), divmod(st.st_mtime_ns, 10**9),
+                         st.st_dev & 0xFFFFFFFF, st.st_ino & 0xFFFFFFFF,
+                         mode_type, mode_perms, st.st_uid, st.st_gid,
+                         st.st_size & 0xFFFFFFFF, sha, False, 0, name, uptodate=True)
+
+def index_entry_stat_matches(e, st):
+    """Does the stat data of the file st match what the index recorded?"""
+    if stat.S_ISLNK(st.st_mode):
+        if e.mode_type != 0b1010:
+            return False
+    elif not stat.S_ISREG(st.st_mode) or e.mode_type != 0b1000:
+        return False
+    elif bool(st.st_mode & 0o100) != bool(e.mode_perms & 0o100):
+        return False
+    return (e.mtime == divmod(st.st_mtime_ns, 10**9)
+            and e.ctime == divmod(st.st_ctime_ns, 10**9)
+            and e.fsize == st.st_size & 0xFFFFFFFF
+            and e.ino == st.st_ino & 0xFFFFFFFF
+            and e.dev == st.st_dev & 0xFFFFFFFF
+            and e.uid == st.st_uid and e.gid == st.st_gid)
+
+def index_entry_racy(index, e):
+    return index.timestamp is not None and \
+        e.mtime[0] * 10**9 + e.mtime[1] >= index.timestamp
+
+def worktree_hash(repo, path, st):
+    """SHA of the blob path would be staged as."""
+    if stat.S_ISLNK(st.st_mode):
+        target = os.fsencode(os.readlink(path))
+        return hashlib.sha1(b"blob " + str(len(target)).encode() + b"\x00" + target).hexdigest()
+    with open(path, "rb") as f:
+        return object_hash(f, b"blob")
+
+def index_entry_changed(repo, index, e, st=None):
+    """Is the worktree file for e different from what's staged?  Files
+    are only hashed when their stat data can't tell."""
+    path = os.path.join(repo.worktree, e.name)
+    if st is None:
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return True
+
+    if index_entry_stat_matches(e, st):
+        if not index_entry_racy(index, e):
+            return False
+    elif e.fsize and e.fsize != st.st_size & 0xFFFFFFFF:
+        # A different size is a change for sure (a size of 0 may just be
+        # a smudged racy entry, or an entry from read-tree).
+        return True
+    elif not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+        return True
+
+    if (e.mode_type == 0b1010) != stat.S_ISLNK(st.st_mode):
+        return True
+    if e.mode_type == 0b1000 and bool(st.st_mode & 0o100) != bool(e.mode_perms & 0o100):
+        return True
+    if worktree_hash(repo, path, st) != e.sha:
+        return True
+    if index_entry_stat_matches(e, st):
+        e.uptodate = True
+    return False
+
+argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+
+argsp.add_argument("-j",
+                   dest="jobs",
+                   type=int,
+                   default=os.cpu_count(),
+                   help="Number of threads hashing files")
+
+def cmd_status(args):
+    repo = repo_find()
+    index = index_read(repo)
+
+    cmd_status_branch(repo)
+    cmd_status_head_index(repo, index)
+    print()
+    cmd_status_index_worktree(repo, index, jobs=args.jobs)
 
+def branch_get_active(repo):
+    with open(repo_file(repo, "HEAD"), "r") as f:
+        head = f.read()
 
+    if head.startswith("ref: refs/heads/"):
+        return(head[16:-1])
+    else:
+        return False
+
+def cmd_status_branch(repo):
+    branch = branch_get_active(repo)
+    if branch:
+        print(f"On branch {branch}.")
+    else:
+        print(f"HEAD detached at {object_find(repo, 'HEAD')}")
+
+def tree_index_diff(repo, tree_sha, entries, node=None):
+    """Compare tree tree_sha with the index entries (sorted, stage 0)
+    and yield (path, old leaf, new leaf) for each difference, in path
+    order, like tree_diff.  The new leaf is built from the index entry.
+    Directories whose TREE extension node is valid and has the same SHA
+    as the tree aren't looked at at all."""
+    def added(e):
+        return e.name, None, GitTreeLeaf(index_entry_mode(e), e.name, e.sha)
+
+    def walk(sha, start, end, prefix, node):
+        # entries[start:end] are exactly those under prefix.
+        if node is not None and node.entry_count >= 0 and node.sha == sha \
+           and node.entry_count == end - start:
+            return
+        i = start
+        leaves = object_read(repo, sha).items if sha else []
+        # Both the leaves and the entries are in path order: walk them
+        # in lockstep.
+        for leaf in leaves:
+            path = prefix + leaf.path
+            if leaf.mode.startswith(b"04"):
+                path += "/"
+            while i < end and entries[i].name < path:
+                yield added(entries[i])
+                i += 1
+
+            if leaf.mode.startswith(b"04"):
+                j = i
+                while j < end and entries[j].name.startswith(path):
+                    j += 1
+                if i == j:
+                    yield from tree_diff(repo, leaf.sha, None, path)
+                else:
+                    sub = node.subtree(leaf.path) if node is not None else None
+                    yield from walk(leaf.sha, i, j, path, sub)
+                i = j
+            elif i < end and entries[i].name == path:
+                e = entries[i]
+                i += 1
+                if e.sha != leaf.sha or index_entry_mode(e) != leaf.mode:
+                    yield path, leaf, added(e)[2]
+            else:
+                yield path, leaf, None
+
+        while i < end:
+            yield added(entries[i])
+            i += 1
+
+    return walk(tree_sha, 0, len(entries), "", node)
+
+def cmd_status_head_index(repo, index):
+    print("Changes to be committed:")
+
+    head = ref_resolve(repo, "HEAD")
+    tree = object_find(repo, head, fmt=b"tree") if head else None
+    entries = [ e for e in index.entries if not e.flag_stage and not e.flag_intent_to_add ]
+    for path, old, new in tree_index_diff(repo, tree, entries, index.cache_tree):
+        status = "added" if old is None else "deleted" if new is None else "modified"
+        print(f"  {status+':':10}{path}")
+
+def cmd_status_index_worktree(repo, index, jobs=1):
+    print("Changes not staged for commit:")
+
+    tracked = set()
+    # Entries whose stat data doesn't settle it, to hash.
+    suspects = list()
+    changes = dict()
+    for e in index.entries:
+        tracked.add(e.name)
+        if e.flag_skip_worktree or e.mode_type == 0b1110:
+            continue
+        path = os.path.join(repo.worktree, e.name)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            changes[e.name] = "deleted"
+            continue
+
+        if e.flag_intent_to_add:
+            changes[e.name] = "added"
+        elif not index_entry_stat_matches(e, st) or index_entry_racy(index, e):
+            suspects.append((e, st))
+
+    def check(suspect):
+        return index_entry_changed(repo, index, *suspect)
+
+    if jobs > 1 and len(suspects) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(check, suspects))
+    else:
+        results = list(map(check, suspects))
+
+    refreshed = False
+    for (e, st), changed in zip(suspects, results):
+        if changed:
+            changes[e.name] = "modified"
+        elif not index_entry_stat_matches(e, st):
+            # Same content, new stat data: remember it, so next time we
+            # don't have to hash the file again.
+            new = index_entry_from_stat(e.name, e.sha, st)
+            e.ctime, e.mtime, e.dev, e.ino = new.ctime, new.mtime, new.dev, new.ino
+            e.uid, e.gid, e.fsize = new.uid, new.gid, new.fsize
+            # Just hashed: index_write() needn't check it again.
+            e.uptodate = True
+            refreshed = True
+
+    for e in index.entries:
+        if e.name in changes:
+            print(f"  {changes.pop(e.name)+':':10}{e.name}")
+
+    print()
+    print("Untracked files:")
+    for path in sorted(worktree_files(repo, ignore=gitignore_read(repo), tracked=tracked)):
+        if path not in tracked:
+            print(f"  {path}")
+
+    if refreshed:
+        index_write(repo, index)
+
+def worktree_files(repo, prefix="", ignore=None, tracked=()):
+    """Every file of the worktree under prefix (empty, or a directory
+    ending with a slash), relative to the worktree, in no special order.
+    Nested repositories (submodules among them) are not walked into, and
+    if ignore (a GitIgnore) is given, neither are ignored directories and
+    ignored files are skipped, unless they are in tracked."""
+    stack = [ prefix ]
+    while stack:
+        prefix = stack.pop()
+        with os.scandir(os.path.join(repo.worktree, prefix)) as it:
+            for entry in it:
+                path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if path == ".git" or os.path.lexists(os.path.join(entry.path, ".git")):
+                        continue
+                    # Nothing under an ignored directory can be
+                    # unignored: don't even look inside.
+                    if ignore is None or not gitignore_match(ignore, path, True):
+                        stack.append(path + "/")
+                elif ignore is None or path in tracked or not gitignore_match(ignore, path, False):
+                    yield path
+
+
+# Staging
+# =======
+#
+# add walks the paths it's given, then hashes and compresses the files
+# that changed since they were staged with a pool of threads: hashlib
+# and zlib both release the GIL on big enough buffers.  The new entries
+# are merged back into the index in path order, whatever order the
+# threads finished in.
+
+argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
+
+argsp.add_argument("path", nargs="+", help="Files to add")
+
+argsp.add_argument("-j",
+                   dest="jobs",
+                   type=int,
+                   default=os.cpu_count(),
+                   help="Number of threads hashing files")
+
+def cmd_add(args):
+    repo = repo_find()
+    add(repo, args.path, jobs=args.jobs)
+
+def worktree_relpath(repo, path):
+    # The worktree path is a realpath, but don't resolve path itself:
+    # it may be a symlink we want to stage as such.
+    path = os.path.abspath(path)
+    rel = os.path.relpath(os.path.join(os.path.realpath(os.path.dirname(path)),
+                                       os.path.basename(path)), repo.worktree)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise Exception(f"Path outside of the worktree: {path}")
+    rel = rel.replace(os.sep, "/")
+    return "" if rel == "." else rel
+
+def add(repo, paths, jobs=1):
+    index = index_read(repo)
+    entries = { e.name: e for e in index.entries if not e.flag_stage }
+
+    ignore = gitignore_read(repo)
+    names = set()
+    removed = set()
+    for path in paths:
+        rel = worktree_relpath(repo, path)
+        full = os.path.join(repo.worktree, rel)
+        if os.path.isdir(full) and not os.path.islink(full):
+            prefix = rel + "/" if rel else ""
+            tracked = [ n for n in entries if n.startswith(prefix) ]
+            if not tracked and rel and gitignore_check(ignore, rel, True):
+                raise Exception(f"Path {path} is ignored")
+            names |= set(worktree_files(repo, prefix, ignore))
+            # Ignore rules don't apply to tracked files: these are added
+            # even if they're in an ignored directory, or unstaged if
+            # they were deleted.
+            for n in tracked:
+                if os.path.lexists(os.path.join(repo.worktree, n)):
+                    names.add(n)
+                else:
+                    removed.add(n)
+        elif os.path.lexists(full):
+            if rel not in entries and gitignore_check(ignore, rel, False):
+                raise Exception(f"Path {path} is ignored")
+            names.add(rel)
+        elif rel in entries:
+            removed.add(rel)
+        else:
+            raise Exception(f"Path {path} did not match any files")
+
+    # Only hash what changed since it was staged.
+    todo = list()
+    for name in sorted(names):
+        st = os.lstat(os.path.join(repo.worktree, name))
+        e = entries.get(name)
+        if e is not None and index_entry_stat_matches(e, st) and not index_entry_racy(index, e):
+            continue
+        todo.append((name, st))
+
+    def stage(item):
+        name, st = item
+        path = os.path.join(repo.worktree, name)
+        if stat.S_ISLNK(st.st_mode):
+            sha = object_write(GitBlob(os.fsencode(os.readlink(path))), repo)
+        else:
+            with open(path, "rb") as f:
+                sha = object_hash(f, b"blob", repo)
+        return index_entry_from_stat(name, sha, st)
+
+    if jobs > 1 and len(todo) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            staged = list(pool.map(stage, todo))
+    else:
+        staged = list(map(stage, todo))
+
+    for e in staged:
+        old = entries.get(e.name)
+        if old is None or old.sha != e.sha or index_entry_mode(old) != index_entry_mode(e):
+            cache_tree_invalidate(index, e.name)
+        entries[e.name] = e
+    for name in removed:
+        del entries[name]
+        cache_tree_invalidate(index, name)
+
+    # Adding a path resolves its conflict, if any.
+    unmerged = [ e for e in index.entries if e.flag_stage and e.name not in names ]
+    index.entries = sorted(list(entries.values()) + unmerged,
+                           key=lambda e: (e.name.encode("utf8"), e.flag_stage))
+    index_write(repo, index)
+
+
+# Ignore rules
+# ============
+#
+# Rules come from every .gitignore in the worktree, each applying to its
+# own directory, then from .git/info/exclude and the global excludes
+# file.  Deeper files win over shallower ones, and in a file the last
+# matching rule wins.  Instead of trying each rule in turn with fnmatch,
+# each file is compiled into one regular expression, an alternation of
+# its rules in reverse order: the first alternative that matches is the
+# rule that decides, and m.lastindex tells us which one it was.
+
+class GitIgnoreRules(object):
+    """The rules of one ignore file.  Each rule is a tuple (source,
+    line number, pattern, negated, dir_only, line as written)."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        # Rules without a slash are matched against the last component
+        # of paths only, the others against the whole path: no ".*/"
+        # prefix to backtrack over.  Rules ending with a slash only match
+        # directories, so we keep a set of regexes for each case.
+        self.files = gitignore_compile([ (i, r) for i, r in enumerate(rules) if not r[4] ])
+        self.dirs = gitignore_compile(list(enumerate(rules)))
+
+class GitIgnore(object):
+    absolute = None
+    # Directory ("" or ending with a slash) -> GitIgnoreRules of its
+    # .gitignore, or None if it hasn't any.
+    scoped = None
+
+    def __init__(self, worktree, absolute):
+        self.worktree = worktree
+        self.absolute = absolute
+        self.scoped = dict()
+        # Directories we already know are (not) ignored.
+        self.dirs = dict()
+
+def gitignore_pattern_regex(pattern):
+    """Translate a gitignore glob into a regex.  Patterns with a slash
+    (but at the end) are matched against paths relative to the directory
+    of their ignore file, the others against names, at any depth."""
+    if pattern.startswith("/"):
+        pattern = pattern[1:]
+
+    out = list()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i) and (i == 0 or pattern[i-1] == "/") \
+               and (i + 2 == n or pattern[i+2] == "/"):
+                if i + 2 == n:
+                    out.append(".+") # "foo/**": everything inside foo
+                else:
+                    out.append("(?:.*/)?") # "**/" : any number of directories
+                    i += 1
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                out.append(re.escape(c))
+            else:
+                content = pattern[i+1:j].replace("\\", "\\\\").replace("[", "\\[")
+                if content[0] in "!^":
+                    out.append("(?!/)[^" + content[1:] + "]")
+                else:
+                    out.append("[" + content + "]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+
+    return "".join(out)
+
+def gitignore_compile(rules):
+    """rules is a list of (index, rule).  Return ((name regex, indexes),
+    (path regex, indexes)), indexes being those of the rules of each
+    alternative, in order."""
+    ret = list()
+    for anchored in (False, True):
+        subset = [ (i, r) for i, r in reversed(rules) if ("/" in r[2]) == anchored ]
+        if not subset:
+            ret.append((None, None))
+            continue
+        regexes = [ gitignore_pattern_regex(r[2]) for i, r in subset ]
+        ret.append((re.compile("|".join(f"({x})\\Z" for x in regexes), re.DOTALL),
+                    [ i for i, r in subset ]))
+    return ret
+
+def gitignore_parse(lines, source):
+    rules = list()
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        if not line or line.startswith("#"):
+            continue
+        # Trailing spaces are ignored, unless escaped.
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        pattern = stripped
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        if dir_only:
+            pattern = pattern.rstrip("/")
+        if pattern:
+            rules.append((source, lineno, pattern, negated, dir_only, stripped))
+    return GitIgnoreRules(rules) if rules else None
+
+def gitignore_read_file(path, source):
+    try:
+        with open(path, "r", encoding="utf8", errors="surrogateescape") as f:
+            return gitignore_parse(f, source)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+
+def gitignore_read(repo):
+    absolute = list()
+    rules = gitignore_read_file(repo_path(repo, "info", "exclude"), ".git/info/exclude")
+    if rules:
+        absolute.append(rules)
+
+    global_file = repo.conf.get("core", "excludesfile", fallback=None)
+    if global_file is None:
+        config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+        global_file = os.path.join(config_home, "git", "ignore")
+    rules = gitignore_read_file(os.path.expanduser(global_file), global_file)
+    if rules:
+        absolute.append(rules)
+
+    return GitIgnore(repo.worktree, absolute)
+
+def gitignore_scoped(ignore, directory):
+    """The rules of directory's .gitignore, read at most once."""
+    try:
+        return ignore.scoped[directory]
+    except KeyError:
+        rules = gitignore_read_file(os.path.join(ignore.worktree, directory, ".gitignore"),
+                                    directory + ".gitignore")
+        ignore.scoped[directory] = rules
+        return rules
+
+def gitignore_rule(ignore, path, is_dir):
+    """The rule deciding whether path is ignored, or None.  Only path
+    itself is looked at, not its parent directories."""
+    # Closest .gitignore first.
+    slash = path.rfind("/")
+    while True:
+        directory = path[:slash+1]
+        rules = gitignore_scoped(ignore, directory)
+        if rules:
+            rule = gitignore_rules_match(rules, path[len(directory):], is_dir)
+            if rule:
+                return rule
+        if slash == -1:
+            break
+        slash = path.rfind("/", 0, slash)
+
+    for rules in ignore.absolute:
+        rule = gitignore_rules_match(rules, path, is_dir)
+        if rule:
+            return rule
+    return None
+
+def gitignore_rules_match(rules, path, is_dir):
+    (name_re, name_rules), (path_re, path_rules) = rules.dirs if is_dir else rules.files
+    best = -1
+    if name_re is not None:
+        m = name_re.match(path, path.rfind("/") + 1)
+        if m:
+            best = name_rules[m.lastindex - 1]
+    if path_re is not None:
+        m = path_re.match(path)
+        if m:
+            best = max(best, path_rules[m.lastindex - 1])
+    # The last rule of the file wins.
+    return rules.rules[best] if best >= 0 else None
+
+def gitignore_match(ignore, path, is_dir):
+    """Is path ignored, assuming its parent directories aren't?"""
+    rule = gitignore_rule(ignore, path, is_dir)
+    return rule is not None and not rule[3]
+
+def gitignore_check(ignore, path, is_dir):
+    """Is path ignored, itself or because one of its parent directories
+    is?"""
+    return gitignore_check_rule(ignore, path, is_dir)[0]
+
+def gitignore_check_rule(ignore, path, is_dir):
+    """Return (ignored, rule): rule is the one that decided, if any."""
+    slash = path.find("/")
+    while slash != -1:
+        directory = path[:slash]
+        if directory not in ignore.dirs:
+            rule = gitignore_rule(ignore, directory, True)
+            ignore.dirs[directory] = rule if rule is not None and not rule[3] else None
+        if ignore.dirs[directory]:
+            return True, ignore.dirs[directory]
+        slash = path.find("/", slash + 1)
+
+    rule = gitignore_rule(ignore, path, is_dir)
+    return rule is not None and not rule[3], rule
+
+argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
+argsp.add_argument("-v", "--verbose", action="store_true",
+                   help="Also print the rule that matched.")
+argsp.add_argument("--stdin", action="store_true",
+                   help="Read paths from standard input, one per line.")
+argsp.add_argument("path", nargs="*", help="Paths to check")
+
+def cmd_check_ignore(args):
+    repo = repo_find()
+    ignore = gitignore_read(repo)
+    # Tracked files are never ignored.
+    tracked = { e.name for e in index_read(repo).entries }
+
+    if args.stdin:
+        paths = (line.rstrip("\n") for line in sys.stdin)
+    else:
+        paths = args.path
+
+    for path in paths:
+        if not path:
+            continue
+        rel = worktree_relpath(repo, path)
+        if rel in tracked:
+            continue
+        is_dir = path.endswith("/") or os.path.isdir(os.path.join(repo.worktree, rel))
+        ignored, rule = gitignore_check_rule(ignore, rel, is_dir)
+        if args.verbose and rule:
+            # Like git, show negated rules that matched too.
+            print(f"{rule[0]}:{rule[1]}:{rule[5]}\t{path}")
+        elif ignored:
+            print(path)
+        if args.stdin:
+            # Someone may be waiting for this answer to send the next path.
+            sys.stdout.flush()
+
+
+# Daemon
+# ======
+#
+# wyag daemon keeps a GitRepo, and so its object, ref and pack caches,
+# alive between commands.  It listens on .git/wyag.sock; when that
+# socket exists, the read-only commands below are sent to it instead of
+# being run in a fresh process.  A request is a JSON line:
+#
+#   {"argv": [...], "cwd": "..."}
+#
+# and the answer is "<exit status> <length>\n", followed by that many
+# bytes: the output of the command, or its error if the status isn't 0.
+# Commands run one at a time, on a single worker thread (they redirect
+# sys.stdout and chdir, which are process-wide), while the event loop
+# keeps accepting clients.
+
+DAEMON_COMMANDS = ("cat-file", "log", "ls-tree", "rev-parse")
+DAEMON_SOCKET = "wyag.sock"
+
+# True in the daemon itself, so that it runs what it's asked to.
+daemon_serving = False
+
+def daemon_socket_find(path="."):
+    """Return the socket of the daemon serving the repository containing
+    path, if there's one.  This runs before every forwarded command, so
+    it doesn't even build a GitRepo."""
+    path = os.path.realpath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, ".git")):
+            sock = os.path.join(path, ".git", DAEMON_SOCKET)
+            return sock if os.path.exists(sock) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def daemon_forward(argv):
+    """Run argv through the daemon and return its exit status, after
+    copying its output.  Return None if it should run here instead."""
+    if daemon_serving or os.environ.get("WYAG_NO_DAEMON"):
+        return None
+    if not argv or argv[0] not in DAEMON_COMMANDS:
+        return None
+    # The batch modes read our stdin.
+    if "--batch" in argv or "--batch-check" in argv or "-h" in argv or "--help" in argv:
+        return None
+    path = daemon_socket_find()
+    if path is None:
+        return None
+
+    import json, socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            request = json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n"
+            sock.sendall(request.encode("utf8"))
+            f = sock.makefile("rb")
+            header = f.readline()
+            if not header:
+                return None
+            status, length = (int(x) for x in header.split())
+            data = f.read(length)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # A stale socket: the daemon is gone.
+        return None
+
+    out = sys.stdout.buffer if status == 0 else sys.stderr.buffer
+    out.write(data)
+    out.flush()
+    return status
+
+def daemon_run(argv, cwd):
+    """Run a command like main() would, returning (status, output)."""
+    import io
+    buffer = io.BytesIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    out = io.TextIOWrapper(buffer, encoding="utf8", write_through=True)
+    sys.stdout = sys.stderr = out
+    status = 0
+    try:
+        os.chdir(cwd)
+        main(argv)
+    except SystemExit as e:
+        # argparse errors and --help
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(f"{type(e).__name__}: {e}\n".encode("utf8"))
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        # Don't let the wrapper close buffer when it goes away.
+        out.detach()
+    return status, buffer.getvalue()
+
+def daemon_refresh(repos, pack_mtimes):
+    """Forget what other processes may have changed under us since the
+    last request.  Refs and packed-refs check their own mtime.
+    pack_mtimes maps worktrees to the mtime of their pack directory."""
+    for worktree, repo in repos.items():
+        # A gc replaces packs and the commit-graph.
+        try:
+            mtime = os.stat(repo_path(repo, "objects", "pack")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if pack_mtimes.get(worktree) != mtime:
+            repo.packs = None
+            repo.commit_graph = None
+            pack_mtimes[worktree] = mtime
+        # New loose objects, for short hashes.
+        repo.loose_index.clear()
+
+argsp = argsubparsers.add_parser("daemon", help="Serve read-only commands from a long-running process.")
+
+def cmd_daemon(args):
+    global repo_instances, daemon_serving
+    import asyncio, json
+    from concurrent.futures import ThreadPoolExecutor
+
+    repo = repo_find()
+    repo_instances = { repo.worktree: repo }
+    daemon_serving = True
+    path = repo_path(repo, DAEMON_SOCKET)
+    worker = ThreadPoolExecutor(max_workers=1)
+    pack_mtimes = dict()
+
+    def run(argv, cwd):
+        daemon_refresh(repo_instances, pack_mtimes)
+        return daemon_run(argv, cwd)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                argv = request["argv"]
+                if not argv or argv[0] not in DAEMON_COMMANDS:
+                    status, data = 1, f"The daemon doesn't run {argv[:1]}\n".encode()
+                else:
+                    status, data = await asyncio.get_running_loop().run_in_executor(
+                        worker, run, argv, request["cwd"])
+                writer.write(f"{status} {len(data)}\n".encode() + data)
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(handle, path=path)
+        stop = asyncio.Event()
+        import signal
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        print(f"Serving {repo.worktree} on {path}", file=sys.stderr)
+        async with server:
+            await stop.wait()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        worker.shutdown()
+
+
+# Async API
+# =========
+#
+# For asyncio applications embedding wyag.  AsyncGitRepo wraps a GitRepo
+# and runs the blocking functions above on a thread pool.  Reads of the
+# same SHA already in flight are coalesced: the second caller just
+# waits for the first read.  Batches (objects_read, and each level of
+# tree_walk) go to the pool as a single job rather than one per object.
+
+class AsyncGitRepo(object):
+
+    def __init__(self, repo, max_workers=None, executor=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.repo = repo
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        # (kind, sha) -> asyncio future of a read in progress
+        self.inflight = dict()
+        # Load the pack indexes once, before the threads race to.
+        repo_packs(repo)
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on the pool."""
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def coalesce(self, kind, fn, shas):
+        """Return [fn(repo, sha) for sha in shas], starting a single
+        pool job for the shas nobody is reading yet."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        waiting = list()
+        todo = list()
+        for sha in shas:
+            future = self.inflight.get((kind, sha))
+            if future is None:
+                future = loop.create_future()
+                self.inflight[(kind, sha)] = future
+                todo.append(sha)
+            waiting.append(future)
+
+        if todo:
+            def read():
+                results = list()
+                for sha in todo:
+                    try:
+                        results.append((fn(self.repo, sha), None))
+                    except Exception as e:
+                        results.append((None, e))
+                return results
+
+            def done(job):
+                # Runs even if our caller was cancelled: others may wait
+                # on the same futures.
+                error = job.exception() if not job.cancelled() else asyncio.CancelledError()
+                results = job.result() if error is None else [ (None, error) ] * len(todo)
+                for sha, (value, e) in zip(todo, results):
+                    future = self.inflight.pop((kind, sha))
+                    if future.done():
+                        continue
+                    if e is None:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(e)
+
+            loop.run_in_executor(self.executor, read).add_done_callback(done)
+
+        # shield(): a cancelled caller mustn't cancel the futures others
+        # are waiting on.
+        return await asyncio.gather(*(asyncio.shield(f) for f in waiting))
+
+    async def object_read(self, sha):
+        return (await self.coalesce("object", object_read, [ sha ]))[0]
+
+    async def objects_read(self, shas):
+        return await self.coalesce("object", object_read, shas)
+
+    async def object_read_raw(self, sha):
+        return (await self.coalesce("raw", object_read_raw, [ sha ]))[0]
+
+    async def object_write(self, obj):
+        return await self.run(object_write, obj, self.repo)
+
+    async def object_find(self, name, fmt=None, follow=True):
+        return await self.run(object_find, self.repo, name, fmt, follow)
+
+    async def ref_resolve(self, ref):
+        return await self.run(ref_resolve, self.repo, ref)
+
+    async def index_read(self):
+        return await self.run(index_read, self.repo)
+
+    async def tree_walk(self, sha, prefix=""):
+        """Yield (path, leaf) for every leaf under tree sha, recursively,
+        a level of the tree at a time: all the subtrees of a level are
+        read in a single batch."""
+        level = [ (sha, prefix) ]
+        while level:
+            trees = await self.objects_read([ sha for sha, _ in level ])
+            next_level = list()
+            for tree, (_, prefix) in zip(trees, level):
+                for leaf in tree.items:
+                    path = prefix + leaf.path
+                    yield path, leaf
+                    if leaf.mode.startswith(b"04"):
+                        next_level.append((leaf.sha, path + "/"))
+            level = next_level
+
+    def close(self):
+        self.executor.shutdown()
+
+
+# Tree diff
+# =========
+#
+# The entries of a tree are sorted (tree_leaf_sort_key), so two trees
+# are compared by walking their entries in lockstep, like a merge.  A
+# subtree with the same SHA on both sides is identical, whatever its
+# size: it is skipped without being read.  So is every unchanged entry
+# of a tree that did change, by comparing its raw bytes, before any
+# leaf gets built.
+
+def tree_diff_key(raw, start, space, nul):
+    name = bytes(raw[space+1:nul])
+    if raw[start] == ord("4") or raw[start+1] == ord("4"):
+        return name + b"/"
+    return name
+
+def tree_diff(repo, old, new, prefix="", recursive=True):
+    """Yield (path, old leaf, new leaf) for every difference between
+    the trees old and new (SHAs, None for an empty tree), in path
+    order.  A leaf is None on the side where the path doesn't exist.
+    If recursive, differing subtrees are descended into and only their
+    blobs are reported; otherwise the subtree leaves themselves are."""
+    if old == new:
+        return
+    a = object_read(repo, old) if old else GitTree()
+    b = object_read(repo, new) if new else GitTree()
+    araw, aoff = a.raw or b"", a.offsets or array("I")
+    braw, boff = b.raw or b"", b.offsets or array("I")
+    na = len(aoff)
+    nb = len(boff)
+
+    i = j = 0
+    while i < na or j < nb:
+        if i == na:
+            take = 1
+        elif j == nb:
+            take = -1
+        elif araw[aoff[i]:aoff[i+2]+21] == braw[boff[j]:boff[j+2]+21]:
+            # Same mode, name and SHA.
+            i += 3
+            j += 3
+            continue
+        else:
+            ka = tree_diff_key(araw, *aoff[i:i+3])
+            kb = tree_diff_key(braw, *boff[j:j+3])
+            take = -1 if ka < kb else 1 if ka > kb else 0
+
+        leaf = other = None
+        if take <= 0:
+            leaf = tree_leaf_at(araw, aoff, i // 3)
+            i += 3
+        if take >= 0:
+            other = tree_leaf_at(braw, boff, j // 3)
+            j += 3
+
+        either = leaf or other
+        path = prefix + either.path
+        if recursive and either.mode.startswith(b"04"):
+            yield from tree_diff(repo, leaf and leaf.sha, other and other.sha, path + "/")
+        else:
+            yield path, leaf, other
+
+def tree_diff_status(old, new):
+    if old is None:
+        return "A"
+    if new is None:
+        return "D"
+    if old.mode[:2] != new.mode[:2]:
+        return "T"
+    return "M"
+
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content and mode of blobs found via two tree objects.")
+argsp.add_argument("-r",
+                   dest="recursive",
+                   action="store_true",
+                   help="Recurse into sub-trees")
+
+argsp.add_argument("tree",
+                   nargs="+",
+                   help="One commit, compared to its first parent, or two tree-ish objects.")
+
+def cmd_diff_tree(args):
+    repo = repo_find()
+    if len(args.tree) > 2:
+        raise Exception("diff-tree takes one or two tree-ish objects.")
+
+    if len(args.tree) == 1:
+        sha = object_find(repo, args.tree[0], fmt=b"commit")
+        parents = commit_parents(repo, sha)
+        # Like git without -m, root commits and merges show nothing.
+        if len(parents) != 1:
+            return
+        header = sha
+        old, new = parents[0], sha
+    else:
+        header = None
+        old, new = args.tree
+
+    old = object_find(repo, old, fmt=b"tree")
+    new = object_find(repo, new, fmt=b"tree")
+    null = "0" * 40
+    for path, a, b in tree_diff(repo, old, new, recursive=args.recursive):
+        # The commit is only shown if it changed something.
+        if header:
+            print(header)
+            header = None
+        print(f":{a.mode.decode("ascii") if a else "000000"} "
+              f"{b.mode.decode("ascii") if b else "000000"} "
+              f"{a.sha if a else null} {b.sha if b else null} "
+              f"{tree_diff_status(a, b)}\t{path}")
+
+
+# Incremental checkout
+# ====================
+#
+# Switching the worktree to another commit only touches the paths that
+# differ between the trees of HEAD and of that commit, which tree_diff
+# finds without looking into identical subtrees.  Everything is checked
+# before anything is written: a path is only overwritten if its index
+# entry and worktree file are the ones of HEAD, so that no local change
+# is lost.  Staged or unstaged changes to other paths are carried over.
+# The index entries of the written files get their new stat data, so
+# that the next status doesn't need to hash them.
+
+def checkout_conflicts(repo, index, entries, changes):
+    """Return (changed, untracked): the paths of changes (from tree_diff)
+    with local changes that checking them out would lose, and the files
+    not tracked by the checkout that it would overwrite."""
+    def same(e, leaf):
+        if e is None or leaf is None:
+            return e is leaf
+        return e.sha == leaf.sha and index_entry_mode(e) == leaf.mode
+
+    # What the checkout deletes from the worktree, to write it again or
+    # not.
+    removed = { path for path, _, new in changes
+                if path in entries and not same(entries[path], new) }
+
+    changed = list()
+    untracked = list()
+    # Leading directories of new paths known to be fine.
+    dirs = set()
+    for path, old, new in changes:
+        e = entries.get(path)
+        if same(e, new):
+            # Already staged as it will be.
+            continue
+        if not same(e, old):
+            changed.append(path)
+        elif e is not None:
+            if e.mode_type == 0b1110:
+                continue
+            if new is None and not os.path.lexists(os.path.join(repo.worktree, path)):
+                # Deleted already.
+                continue
+            if index_entry_changed(repo, index, e):
+                changed.append(path)
+        else:
+            # Something untracked in the way?  A directory of files that
+            # are about to be deleted is fine.
+            full = os.path.join(repo.worktree, path)
+            if os.path.isdir(full) and not os.path.islink(full):
+                if any(p not in removed for p in worktree_files(repo, path + "/")):
+                    untracked.append(path)
+            elif os.path.lexists(full):
+                untracked.append(path)
+
+        if new is None:
+            continue
+        # Or a file (or a symlink) where a new directory goes?
+        parent = os.path.dirname(path)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            full = os.path.join(repo.worktree, parent)
+            if parent not in removed and os.path.lexists(full) \
+               and (os.path.islink(full) or not os.path.isdir(full)):
+                (changed if parent in entries else untracked).append(parent)
+            parent = os.path.dirname(parent)
+    return changed, untracked
+
+def checkout_remove(repo, path):
+    """Delete path from the worktree, and the directories it leaves
+    empty."""
+    full = os.path.join(repo.worktree, path)
+    try:
+        if os.path.isdir(full) and not os.path.islink(full):
+            os.rmdir(full) # A submodule
+        else:
+            os.unlink(full)
+    except FileNotFoundError:
+        pass
+    parent = os.path.dirname(full)
+    while parent != repo.worktree:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+def checkout(repo, name, jobs=1):
+    """Switch the worktree, index and HEAD of repo to the commit name."""
+    sha = object_find(repo, name, fmt=b"commit")
+    target = object_find(repo, sha, fmt=b"tree")
+    head = ref_resolve(repo, "HEAD")
+    current = object_find(repo, head, fmt=b"tree") if head else None
+
+    index = index_read(repo)
+    if any(e.flag_stage for e in index.entries):
+        raise Exception("You need to resolve your current index first")
+    entries = { e.name: e for e in index.entries }
+
+    changes = list(tree_diff(repo, current, target))
+    changed, untracked = checkout_conflicts(repo, index, entries, changes)
+    if changed or untracked:
+        message = list()
+        if changed:
+            message.append("Your local changes to the following files would be overwritten by checkout:\n" +
+                           "\n".join(f"\t{path}" for path in changed))
+        if untracked:
+            message.append("The following untracked working tree files would be overwritten by checkout:\n" +
+                           "\n".join(f"\t{path}" for path in untracked))
+        raise Exception("\n".join(message))
+
+    removed = list()
+    written = list()
+    for path, old, new in changes:
+        e = entries.get(path)
+        if e is not None and new is not None and e.sha == new.sha \
+           and index_entry_mode(e) == new.mode:
+            continue
+        if e is not None:
+            removed.append(path)
+        cache_tree_invalidate(index, path)
+        if new is not None:
+            written.append((path, new))
+            if not new.mode.startswith(b"16") and object_read_header(repo, new.sha) is None:
+                raise Exception(f"Missing object {new.sha} for {path}")
+
+    # Nothing can fail past this point but the filesystem itself.
+    # Deletions first: a file may be in the way of a new directory, or
+    # the other way around.
+    for path in removed:
+        checkout_remove(repo, path)
+        del entries[path]
+
+    blobs = list()
+    for path, new in written:
+        full = os.path.join(repo.worktree, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        if os.path.isdir(full) and not os.path.islink(full) and not new.mode.startswith(b"16"):
+            # Only empty directories are left there (see
+            # checkout_conflicts).
+            for d, _, _ in os.walk(full, topdown=False):
+                os.rmdir(d)
+        if new.mode.startswith(b"16"):
+            # A submodule: we don't have its objects, leave it empty.
+            os.makedirs(full, exist_ok=True)
+        else:
+            blobs.append((full, new.mode, new.sha))
+    checkout_blobs(repo, blobs, jobs)
+
+    for path, leaf in written:
+        e = index_entry_from_stat(path, leaf.sha, os.lstat(os.path.join(repo.worktree, path)))
+        if leaf.mode.startswith(b"16"):
+            e.mode_type, e.mode_perms = 0b1110, 0
+        entries[path] = e
+    if len(entries) == len(index.entries) and all(e.name in entries for e in index.entries):
+        # Same paths as before, just different content: keep the order.
+        index.entries = [ entries[e.name] for e in index.entries ]
+    else:
+        index.entries = sorted(entries.values(), key=lambda e: e.name.encode("utf8"))
+    index_write(repo, index)
+
+    # Stay on a branch if we were given one, else detach HEAD.
+    if ref_resolve(repo, "refs/heads/" + name) == sha:
+        head = f"ref: refs/heads/{name}\n"
+    else:
+        head = sha + "\n"
+    ref_write(repo, repo_file(repo, "HEAD"), head)
+
+
+# Blob diff
+# =========
+#
+# Lines are interned first: each distinct line gets an integer, and the
+# algorithms below only ever compare integers, never the lines
+# themselves.  The common head and tail of the two sides are matched
+# before anything else: with a small edit to a big file, that's most of
+# the work done.
+#
+# myers is Myers' O((N+M)D) algorithm, in its linear space variant: find
+# the middle snake of the shortest edit script, then split the problem
+# there and solve both halves.  histogram is git's: match the region
+# around the least frequent line the two sides have in common, then
+# recurse on what's on either side of it.  It tends to give more
+# readable diffs on code.
+
+# A NUL in the first 8000 bytes makes a blob binary, like in git.
+DIFF_SNIFF = 8000
+
+# histogram falls back to myers when the lines in common are all more
+# frequent than that.
+DIFF_MAX_CHAIN = 64
+
+def diff_is_binary(data):
+    return b"\x00" in data[:DIFF_SNIFF]
+
+def diff_lines(data):
+    """Split data into lines, keeping the newlines."""
+    lines = bytes(data).split(b"\n")
+    last = lines.pop()
+    lines = [ line + b"\n" for line in lines ]
+    if last:
+        lines.append(last)
+    return lines
+
+def diff_intern(a, b):
+    """Replace each line of a and b by an integer, the same for equal
+    lines."""
+    # Everything in C: number the distinct lines, then look them up.
+    ids = dict(zip(dict.fromkeys(itertools.chain(a, b)), itertools.count()))
+    return list(map(ids.__getitem__, a)), list(map(ids.__getitem__, b))
+
+def diff_run(a, i, b, j, limit):
+    """The length of the run a[i:i+n] == b[j:j+n], at most limit.  Long
+    runs are compared a slice at a time, in C, with doubling slices."""
+    n = 0
+    step = 4
+    while n + step <= limit and a[i+n:i+n+step] == b[j+n:j+n+step]:
+        n += step
+        step *= 2
+    while step > 1:
+        step //= 2
+        if n + step <= limit and a[i+n:i+n+step] == b[j+n:j+n+step]:
+            n += step
+    return n
+
+def diff_run_back(a, i, b, j, limit):
+    """The length of the run a[i-n:i] == b[j-n:j], at most limit."""
+    n = 0
+    step = 4
+    while n + step <= limit and a[i-n-step:i-n] == b[j-n-step:j-n]:
+        n += step
+        step *= 2
+    while step > 1:
+        step //= 2
+        if n + step <= limit and a[i-n-step:i-n] == b[j-n-step:j-n]:
+            n += step
+    return n
+
+def diff_middle_snake(a, alo, ahi, b, blo, bhi):
+    """The middle snake of the shortest edit script from a[alo:ahi] to
+    b[blo:bhi]: (x, y, u, v) such that a[x:u] == b[y:v] is on the
+    script, half of its edits before and half after."""
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    dmax = (n + m + 1) // 2
+    # Furthest x reached on each diagonal k = x - y, forward from the
+    # start and backward from the end.  Negative k wrap around.
+    vf = [ 0 ] * (2 * dmax + 3)
+    vb = [ 0 ] * (2 * dmax + 3)
+    for d in range(dmax + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[k-1] < vf[k+1]):
+                x = vf[k+1]
+            else:
+                x = vf[k-1] + 1
+            y = x - k
+            x0, y0 = x, y
+            if x < n and y < m and a[alo+x] == b[blo+y]:
+                run = diff_run(a, alo + x, b, blo + y, min(n - x, m - y))
+                x += run
+                y += run
+            vf[k] = x
+            if odd and -d < delta - k < d and x + vb[delta-k] >= n:
+                return alo + x0, blo + y0, alo + x, blo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[k-1] < vb[k+1]):
+                x = vb[k+1]
+            else:
+                x = vb[k-1] + 1
+            y = x - k
+            x0, y0 = x, y
+            if x < n and y < m and a[ahi-1-x] == b[bhi-1-y]:
+                run = diff_run_back(a, ahi - x, b, bhi - y, min(n - x, m - y))
+                x += run
+                y += run
+            vb[k] = x
+            if not odd and -d <= delta - k <= d and x + vf[delta-k] >= n:
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+    raise Exception("No middle snake") # Can't happen
+
+def diff_trim(a, alo, ahi, b, blo, bhi, matches):
+    """Match the common head and tail of a[alo:ahi] and b[blo:bhi], and
+    return the bounds of what's left in between."""
+    run = diff_run(a, alo, b, blo, min(ahi - alo, bhi - blo))
+    matches.extend(zip(range(alo, alo + run), range(blo, blo + run)))
+    alo += run
+    blo += run
+    run = diff_run_back(a, ahi, b, bhi, min(ahi - alo, bhi - blo))
+    matches.extend(zip(range(ahi - run, ahi), range(bhi - run, bhi)))
+    return alo, ahi - run, blo, bhi - run
+
+def diff_myers(a, b, alo, ahi, blo, bhi, matches):
+    """Append to matches the (i, j) such that a[i] == b[j] on a
+    shortest edit script from a[alo:ahi] to b[blo:bhi]."""
+    todo = [ (alo, ahi, blo, bhi) ]
+    while todo:
+        alo, ahi, blo, bhi = todo.pop()
+        alo, ahi, blo, bhi = diff_trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+        # Both ends differ, so the script has two edits or more, and
+        # both halves are strictly smaller than the whole.
+        x, y, u, v = diff_middle_snake(a, alo, ahi, b, blo, bhi)
+        matches.extend(zip(range(x, u), range(y, v)))
+        todo.append((alo, x, blo, y))
+        todo.append((u, ahi, v, bhi))
+
+def diff_histogram(a, b, alo, ahi, blo, bhi, matches):
+    """Like diff_myers, with git's histogram algorithm."""
+    todo = [ (alo, ahi, blo, bhi) ]
+    while todo:
+        alo, ahi, blo, bhi = todo.pop()
+        alo, ahi, blo, bhi = diff_trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+
+        where = dict()
+        for i in range(alo, ahi):
+            where.setdefault(a[i], []).append(i)
+
+        # The best region: (lowest occurrence count in it, length,
+        # start in a, start in b).
+        best = None
+        common = False
+        j = blo
+        while j < bhi:
+            positions = where.get(b[j])
+            if positions is None:
+                j += 1
+                continue
+            common = True
+            if len(positions) > DIFF_MAX_CHAIN:
+                j += 1
+                continue
+            next_j = j + 1
+            for i in positions:
+                run = diff_run_back(a, i, b, j, min(i - alo, j - blo))
+                sa, sb = i - run, j - run
+                run = diff_run(a, i + 1, b, j + 1, min(ahi - i, bhi - j) - 1)
+                ea, eb = i + 1 + run, j + 1 + run
+                # Lines of b up to eb are in this region: no need to
+                # start other regions from them.
+                next_j = max(next_j, eb)
+                if best is not None and best[0] == 1 and ea - sa <= best[1]:
+                    continue
+                count = min(len(where[a[t]]) for t in range(sa, ea))
+                if best is None or count < best[0] or (count == best[0] and ea - sa > best[1]):
+                    best = (count, ea - sa, sa, sb)
+            j = next_j
+
+        if best is None:
+            if common:
+                diff_myers(a, b, alo, ahi, blo, bhi, matches)
+            # Else nothing in common: all of a goes, all of b comes.
+            continue
+
+        _, length, sa, sb = best
+        matches.extend(zip(range(sa, sa + length), range(sb, sb + length)))
+        todo.append((alo, sa, blo, sb))
+        todo.append((sa + length, ahi, sb + length, bhi))
+
+DIFF_ALGORITHMS = { "myers": diff_myers, "histogram": diff_histogram }
+
+def diff_changes(a, b, algorithm="myers"):
+    """The changes from the lines a to the lines b, as a list of (i1,
+    i2, j1, j2): a[i1:i2] is replaced with b[j1:j2]."""
+    a, b = diff_intern(a, b)
+    matches = list()
+    DIFF_ALGORITHMS[algorithm](a, b, 0, len(a), 0, len(b), matches)
+    matches.sort()
+    matches.append((len(a), len(b)))
+
+    changes = list()
+    i = j = 0
+    for mi, mj in matches:
+        if mi > i or mj > j:
+            changes.append((i, mi, j, mj))
+        i, j = mi + 1, mj + 1
+    return diff_slide(a, b, changes)
+
+def diff_slide(a, b, changes):
+    """A block of lines only deleted (or only added) can often move: a
+    deleted "x y x" can be either of two. Like git, move such blocks as
+    far down as they go, short of the next change."""
+    for n, (i1, i2, j1, j2) in enumerate(changes):
+        if i1 != i2 and j1 != j2:
+            continue
+        limit = changes[n+1][0] if n + 1 < len(changes) else len(a)
+        if i1 == i2:
+            # Added lines, compared to those of b that follow.
+            while j2 < len(b) and i2 < limit and b[j1] == b[j2]:
+                i1 += 1
+                i2 += 1
+                j1 += 1
+                j2 += 1
+        else:
+            while i2 < limit and a[i1] == a[i2]:
+                i1 += 1
+                i2 += 1
+                j1 += 1
+                j2 += 1
+        changes[n] = (i1, i2, j1, j2)
+    return changes
+
+def diff_func_line(a, i):
+    """The hunk header text for a hunk starting at line i of a: the
+    closest line before it that starts with a letter, "_" or "$"."""
+    while i > 0:
+        i -= 1
+        line = a[i]
+        if line[:1].isalpha() or line[:1] in (b"_", b"$"):
+            return b" " + line[:80].rstrip()
+    return b""
+
+def diff_unified(a, b, changes, context=3):
+    """Yield the lines of the unified diff of changes, from the lines a
+    to the lines b, hunk by hunk."""
+    def emit(prefix, line):
+        if line.endswith(b"\n"):
+            return prefix + line
+        return prefix + line + b"\n\\ No newline at end of file\n"
+
+    start = 0
+    while start < len(changes):
+        # Changes less than two contexts apart go in the same hunk.
+        end = start + 1
+        while end < len(changes) and changes[end][0] - changes[end-1][1] <= 2 * context:
+            end += 1
+        i1, _, j1, _ = changes[start]
+        _, i2, _, j2 = changes[end-1]
+        a1 = max(i1 - context, 0)
+        b1 = j1 - (i1 - a1)
+        a2 = min(i2 + context, len(a))
+        b2 = j2 + (a2 - i2)
+
+        counts = list()
+        for first, count in ((a1, a2 - a1), (b1, b2 - b1)):
+            if count == 1:
+                counts.append(f"{first + 1}")
+            else:
+                counts.append(f"{first + 1 if count else first},{count}")
+        yield f"@@ -{counts[0]} +{counts[1]} @@".encode("ascii") + diff_func_line(a, a1) + b"\n"
+
+        i = a1
+        for ci1, ci2, cj1, cj2 in changes[start:end]:
+            for line in a[i:ci1]:
+                yield emit(b" ", line)
+            for line in a[ci1:ci2]:
+                yield emit(b"-", line)
+            for line in b[cj1:cj2]:
+                yield emit(b"+", line)
+            i = ci2
+        for line in a[i:a2]:
+            yield emit(b" ", line)
+        start = end
+
+def diff_blob(repo, path, old, new, algorithm="myers"):
+    """Yield the lines of the git style diff of path between the leaves
+    old and new, either of which can be None."""
+    null = "0" * 40
+    a_path = f"a/{path}" if old else "/dev/null"
+    b_path = f"b/{path}" if new else "/dev/null"
+    yield f"diff --git a/{path} b/{path}\n".encode("utf8")
+    if old is None:
+        yield f"new file mode {new.mode.decode("ascii")}\n".encode("ascii")
+    elif new is None:
+        yield f"deleted file mode {old.mode.decode("ascii")}\n".encode("ascii")
+    elif old.mode != new.mode:
+        yield f"old mode {old.mode.decode("ascii")}\nnew mode {new.mode.decode("ascii")}\n".encode("ascii")
+
+    mode = f" {old.mode.decode("ascii")}" if old and new and old.mode == new.mode else ""
+    if not old or not new or old.sha != new.sha:
+        length = object_abbrev_len(repo)
+        a = object_abbrev(repo, old.sha, length) if old else null[:length]
+        b = object_abbrev(repo, new.sha, length) if new else null[:length]
+        yield f"index {a}..{b}{mode}\n".encode("ascii")
+    else:
+        return
+
+    def content(leaf):
+        if leaf is None:
+            return b""
+        if leaf.mode.startswith(b"16"):
+            return f"Subproject commit {leaf.sha}\n".encode("ascii")
+        return bytes(object_read_raw(repo, leaf.sha)[1])
+    a = content(old)
+    b = content(new)
+    if diff_is_binary(a) or diff_is_binary(b):
+        yield f"Binary files {a_path} and {b_path} differ\n".encode("utf8")
+        return
+
+    a = diff_lines(a)
+    b = diff_lines(b)
+    changes = diff_changes(a, b, algorithm)
+    # An empty file created or deleted: nothing more to say.
+    if changes:
+        yield f"--- {a_path}\n+++ {b_path}\n".encode("utf8")
+        yield from diff_unified(a, b, changes)
+
+argsp = argsubparsers.add_parser("diff", help="Show changes between two commits or trees.")
+argsp.add_argument("--histogram",
+                   dest="algorithm",
+                   action="store_const",
+                   const="histogram",
+                   default="myers",
+                   help="Use the histogram diff algorithm")
+
+argsp.add_argument("old",
+                   help="The tree-ish to compare from.")
+
+argsp.add_argument("new",
+                   help="The tree-ish to compare to.")
+
+def cmd_diff(args):
+    repo = repo_find()
+    old = object_find(repo, args.old, fmt=b"tree")
+    new = object_find(repo, args.new, fmt=b"tree")
+    out = sys.stdout.buffer
+    for path, a, b in tree_diff(repo, old, new):
+        for line in diff_blob(repo, path, a, b, args.algorithm):
+            out.write(line)
+    out.flush()
+
+
+# Path-limited history
+# ====================
+#
+# log -- <path> only shows the commits that changed path compared to
+# their parents.  Finding out only needs the entries along path in both
+# trees: we go down one component at a time, and stop as soon as the
+# SHAs are the same on both sides, so unrelated subtrees are never
+# read.  Like git, a merge that has path the same as one of its parents
+# is not shown, and only that parent is followed: the history of the
+# other branches didn't make it to the merge, as far as path goes.
+#
+# Even that walk is skipped for most commits with the changed-path Bloom
+# filters git can store in the commit-graph.  Each commit has one, of
+# the paths (and their leading directories) that changed since its
+# first parent:
+#
+#   BIDX: for each commit, the end offset of its filter in BDAT
+#   BDAT: version, number of hashes (7), bits per path (10), then the
+#         filters, one after the other
+#
+# A path is in a filter if the 7 bits it hashes to are set.  If one
+# isn't, the commit definitely didn't touch the path; otherwise it
+# probably did, and we look at the trees to be sure.  A filter of the
+# single byte 0xff is for commits with too many changes to bother.
+
+BLOOM_VERSION = 1
+BLOOM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGED_PATHS = 512
+BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+
+def bloom_murmur3(seed, data, version):
+    """MurmurHash3 (x86, 32 bits) of data.  Version 1 filters come from
+    a git that read the bytes as signed chars: those above 0x7f are sign
+    extended, and so are we."""
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & 0xFFFFFFFF
+    if version == 1:
+        data = [ b - 256 if b > 0x7f else b for b in data ]
+    h = seed
+    n = len(data)
+    tail = n & ~3
+    for i in range(0, tail, 4):
+        k = (data[i] | data[i+1] << 8 | data[i+2] << 16 | data[i+3] << 24) & 0xFFFFFFFF
+        k = rotl(k * 0xcc9e2d51 & 0xFFFFFFFF, 15) * 0x1b873593 & 0xFFFFFFFF
+        h = (rotl(h ^ k, 13) * 5 + 0xe6546b64) & 0xFFFFFFFF
+    k = 0
+    for i in reversed(range(tail, n)):
+        k ^= (data[i] << (8 * (i - tail))) & 0xFFFFFFFF
+    if n & 3:
+        k = rotl(k * 0xcc9e2d51 & 0xFFFFFFFF, 15) * 0x1b873593 & 0xFFFFFFFF
+        h ^= k
+    h ^= n
+    h ^= h >> 16
+    h = h * 0x85ebca6b & 0xFFFFFFFF
+    h ^= h >> 13
+    h = h * 0xc2b2ae35 & 0xFFFFFFFF
+    h ^= h >> 16
+    return h
+
+def bloom_key(path, version=BLOOM_VERSION, hashes=BLOOM_HASHES):
+    """The hashes of path, to set or test bits of a filter with."""
+    data = path.encode("utf8")
+    h0, h1 = (bloom_murmur3(seed, data, version) for seed in BLOOM_SEEDS)
+    return [ (h0 + i * h1) & 0xFFFFFFFF for i in range(hashes) ]
+
+def bloom_contains(bloom, key):
+    bits = len(bloom) * 8
+    for h in key:
+        h %= bits
+        if not bloom[h >> 3] & (1 << (h & 7)):
+            return False
+    return True
+
+def bloom_filter_compute(repo, old, new):
+    """The filter of the paths that changed between trees old (None for
+    a root commit) and new."""
+    paths = set()
+    for n, (path, _, _) in enumerate(tree_diff(repo, old, new)):
+        if n == BLOOM_MAX_CHANGED_PATHS:
+            return b"\xff"
+        while path and path not in paths:
+            paths.add(path)
+            path = path.rpartition("/")[0]
+    if not paths:
+        return b"\x00"
+
+    bloom = bytearray((len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    bits = len(bloom) * 8
+    for path in paths:
+        for h in bloom_key(path):
+            h %= bits
+            bloom[h >> 3] |= 1 << (h & 7)
+    return bytes(bloom)
+
+def bloom_filter(graph, pos):
+    """The filter of the commit at pos in graph, or None."""
+    bidx = graph.chunks.get(b"BIDX")
+    bdat = graph.chunks.get(b"BDAT")
+    if bidx is None or bdat is None:
+        return None
+    start = struct.unpack_from(">I", graph.data, bidx + 4*(pos-1))[0] if pos else 0
+    end = struct.unpack_from(">I", graph.data, bidx + 4*pos)[0]
+    return graph.data[bdat+12+start:bdat+12+end]
+
+def bloom_keys(repo, paths):
+    """For each path, the keys of the path and its leading directories,
+    all of which a filter has if the commit touched path.  None if the
+    repository has no filters."""
+    graph = commit_graph_load(repo)
+    if graph is None or b"BDAT" not in graph.chunks:
+        return None
+    version, hashes, _ = struct.unpack_from(">III", graph.data, graph.chunks[b"BDAT"])
+    if version not in (1, 2):
+        return None
+    ret = list()
+    for path in paths:
+        keys = list()
+        while path:
+            keys.append(bloom_key(path, version, hashes))
+            path = path.rpartition("/")[0]
+        ret.append(keys)
+    return ret
 
+def bloom_maybe_changed(repo, sha, keys):
+    """False if the filters say commit sha didn't touch any of the paths
+    of keys since its first parent, True if it may have."""
+    graph = commit_graph_load(repo)
+    pos = commit_graph_find(graph, sha)
+    if pos is None:
+        return True
+    bloom = bloom_filter(graph, pos)
+    if not bloom:
+        return True
+    return any(all(bloom_contains(bloom, key) for key in path_keys) for path_keys in keys)
+
+def tree_path_changed(repo, old, new, path):
+    """Is path (a file or a directory) different in trees old and new
+    (SHAs, or None)?  Only the trees along path are read, down to the
+    first one that's the same on both sides."""
+    names = path.split("/")
+    for i, name in enumerate(names):
+        if old == new:
+            return False
+        a = tree_find(object_read(repo, old), name) if old else None
+        b = tree_find(object_read(repo, new), name) if new else None
+        if i == len(names) - 1:
+            return (a and (a.mode, a.sha)) != (b and (b.mode, b.sha))
+        # Only trees have something under them.
+        old = a.sha if a is not None and a.mode.startswith(b"04") else None
+        new = b.sha if b is not None and b.mode.startswith(b"04") else None
+
+def log_simplify(repo, sha, tree, parents, paths, keys=None):
+    """For log -- paths: the parents of commit sha to follow, and
+    whether to show it.  A commit with the paths the same as in one of
+    its parents is not shown, and only that parent is followed.  keys
+    are the Bloom filter keys of paths, if there are filters."""
+    if not parents:
+        # A root commit is shown if it has the paths at all.
+        return parents, any(tree_path_changed(repo, None, tree, path) for path in paths)
+    for i, p in enumerate(parents):
+        if i == 0 and keys is not None and not bloom_maybe_changed(repo, sha, keys):
+            return [ p ], False
+        ptree = commit_info(repo, p)[0]
+        if not any(tree_path_changed(repo, ptree, tree, path) for path in paths):
+            return [ p ], False
+    return parents, True
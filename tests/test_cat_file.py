@@ -0,0 +1,78 @@
+"""cat-file --batch and --batch-check against git, over packs written
+by git repack and by wyag gc.  Run with: python -m unittest discover tests"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+WYAG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wyag")
+
+def git(cwd, *args, **kwargs):
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, **kwargs).stdout
+
+def wyag(cwd, *args, **kwargs):
+    env = dict(os.environ, WYAG_NO_DAEMON="1")
+    return subprocess.run([sys.executable, WYAG, *args], cwd=cwd, env=env, capture_output=True, **kwargs)
+
+class BatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        git(cls.dir, "init", "-q")
+        git(cls.dir, "config", "user.name", "wyag")
+        git(cls.dir, "config", "user.email", "wyag@example.com")
+        # Many versions of a few big files of varied text, so that the
+        # pack has long delta chains whose deltas are big enough to be
+        # compressed with dynamic Huffman blocks.
+        rng = random.Random(17)
+        words = [ "".join(rng.choice("abcdefghijklmnopqrstuvwxyz_") for _ in range(rng.randint(2, 12)))
+                  for _ in range(500) ]
+        files = { f"f{i}.py": [ " ".join(rng.choices(words, k=rng.randint(1, 12))) for _ in range(800) ]
+                  for i in range(3) }
+        for n in range(30):
+            for name, lines in files.items():
+                for _ in range(rng.randint(1, 40)):
+                    at = rng.randrange(len(lines))
+                    if rng.random() < 0.5:
+                        lines.insert(at, " ".join(rng.choices(words, k=rng.randint(1, 12))))
+                    else:
+                        del lines[at]
+                with open(os.path.join(cls.dir, name), "w") as f:
+                    f.write("\n".join(lines) + "\n")
+            git(cls.dir, "add", ".")
+            git(cls.dir, "commit", "-q", "-m", f"Commit {n}")
+        objects = git(cls.dir, "rev-list", "--all", "--objects")
+        cls.shas = b"".join(line[:40] + b"\n" for line in objects.splitlines())
+        cls.gc_dir = os.path.join(cls.dir, "gc")
+        shutil.copytree(os.path.join(cls.dir, ".git"), os.path.join(cls.gc_dir, ".git"))
+        git(cls.dir, "repack", "-adq")
+        wyag(cls.gc_dir, "gc")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def check(self, cwd, mode):
+        ours = wyag(cwd, "cat-file", mode, input=self.shas)
+        self.assertEqual(ours.returncode, 0, ours.stderr.decode())
+        self.assertEqual(ours.stdout, git(cwd, "cat-file", mode, input=self.shas))
+
+    def test_batch(self):
+        self.check(self.dir, "--batch")
+
+    def test_batch_check(self):
+        self.check(self.dir, "--batch-check")
+
+    def test_batch_gc(self):
+        self.check(self.gc_dir, "--batch")
+
+    def test_batch_check_gc(self):
+        self.check(self.gc_dir, "--batch-check")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""checkout between commits where a file and a directory trade places.
+Run with: python -m unittest discover tests"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+WYAG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wyag")
+
+def git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True).stdout
+
+def wyag(cwd, *args):
+    env = dict(os.environ, WYAG_NO_DAEMON="1")
+    return subprocess.run([sys.executable, WYAG, *args], cwd=cwd, env=env, capture_output=True)
+
+class CheckoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        git(self.dir, "init", "-q")
+        git(self.dir, "config", "user.name", "wyag")
+        git(self.dir, "config", "user.email", "wyag@example.com")
+        self.write("top.txt", "top\n")
+        git(self.dir, "add", ".")
+        git(self.dir, "commit", "-q", "-m", "A")
+        git(self.dir, "branch", "a")
+        git(self.dir, "rm", "-q", "top.txt")
+        self.write("zz/x", "x\n")
+        git(self.dir, "add", ".")
+        git(self.dir, "commit", "-q", "-m", "B")
+        git(self.dir, "branch", "b")
+        git(self.dir, "rm", "-rq", "zz")
+        self.write("zz", "z\n")
+        git(self.dir, "add", ".")
+        git(self.dir, "commit", "-q", "-m", "C")
+        git(self.dir, "branch", "c")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        path = os.path.join(self.dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(data)
+
+    def checkout(self, name):
+        ret = wyag(self.dir, "checkout", name)
+        self.assertEqual(ret.returncode, 0, ret.stderr.decode())
+
+    def test_untracked_file_in_the_way_of_a_directory(self):
+        self.checkout("a")
+        self.write("zz", "junk\n")
+        ret = wyag(self.dir, "checkout", "b")
+        self.assertNotEqual(ret.returncode, 0)
+        self.assertIn(b"untracked working tree files would be overwritten", ret.stderr)
+        # Nothing was touched.
+        self.assertEqual(git(self.dir, "status", "--porcelain"), b"?? zz\n")
+        self.assertEqual(git(self.dir, "symbolic-ref", "HEAD"), b"refs/heads/a\n")
+
+    def test_tracked_file_replaced_by_a_directory(self):
+        self.checkout("c")
+        self.checkout("b")
+        self.assertEqual(git(self.dir, "status", "--porcelain"), b"")
+        self.checkout("c")
+        self.assertEqual(git(self.dir, "status", "--porcelain"), b"")
+
+    def test_empty_directory_in_the_way_of_a_file(self):
+        self.checkout("b")
+        os.makedirs(os.path.join(self.dir, "zz", "empty"))
+        self.checkout("c")
+        self.assertEqual(git(self.dir, "status", "--porcelain"), b"")
+
+if __name__ == "__main__":
+    unittest.main()
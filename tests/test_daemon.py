@@ -0,0 +1,127 @@
+"""Many clients at once against wyag daemon: each gets the output and
+exit status it would get running the command itself.
+Run with: python -m unittest discover tests"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+WYAG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wyag")
+
+# Simultaneous clients.
+CLIENTS = 64
+
+def git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True).stdout
+
+def wyag(cwd, *args, daemon=True):
+    env = dict(os.environ)
+    if daemon:
+        env.pop("WYAG_NO_DAEMON", None)
+    else:
+        env["WYAG_NO_DAEMON"] = "1"
+    return subprocess.run([sys.executable, WYAG, *args], cwd=cwd, env=env, capture_output=True)
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        git(self.dir, "init", "-q")
+        git(self.dir, "config", "user.name", "wyag")
+        git(self.dir, "config", "user.email", "wyag@example.com")
+        for n in range(10):
+            os.makedirs(os.path.join(self.dir, f"d{n % 3}"), exist_ok=True)
+            with open(os.path.join(self.dir, f"d{n % 3}", f"f{n}"), "w") as f:
+                f.write(f"{n}\n" * (n + 1))
+            git(self.dir, "add", ".")
+            git(self.dir, "commit", "-q", "-m", f"Commit {n}")
+
+        self.socket = os.path.join(self.dir, ".git", "wyag.sock")
+        env = dict(os.environ)
+        env.pop("WYAG_NO_DAEMON", None)
+        self.daemon = subprocess.Popen([sys.executable, WYAG, "daemon"], cwd=self.dir, env=env,
+                                       stderr=subprocess.DEVNULL)
+        for _ in range(500):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("The daemon didn't create its socket")
+
+    def tearDown(self):
+        if self.daemon.poll() is None:
+            self.daemon.kill()
+            self.daemon.wait()
+        shutil.rmtree(self.dir)
+
+    def requests(self):
+        """(argv, should it succeed) for commands covering every object,
+        plus some that fail."""
+        objects = git(self.dir, "cat-file", "--batch-all-objects",
+                      "--batch-check=%(objecttype) %(objectname)").decode().split("\n")
+        commits = git(self.dir, "rev-list", "HEAD").decode().split()
+        ret = [ (["log", "HEAD"], True), (["ls-tree", "-r", "HEAD"], True),
+                (["rev-parse", "HEAD"], True), (["ls-tree", commits[3]], True),
+                (["rev-parse", "nothing"], False), (["cat-file", "blob", "nothing"], False) ]
+        for line in objects:
+            if line:
+                type, sha = line.split()
+                ret.append((["cat-file", type, sha], True))
+        return (ret * (CLIENTS // len(ret) + 1))[:max(CLIENTS, len(ret))]
+
+    def ask(self, argv):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket)
+            sock.sendall((json.dumps({"argv": argv, "cwd": self.dir}) + "\n").encode())
+            f = sock.makefile("rb")
+            status, length = (int(x) for x in f.readline().split())
+            return status, f.read(length)
+
+    def test_concurrent_clients(self):
+        requests = self.requests()
+        expected = dict()
+        for argv, success in requests:
+            if tuple(argv) not in expected:
+                ret = wyag(self.dir, *argv, daemon=False)
+                self.assertEqual(ret.returncode == 0, success, argv)
+                expected[tuple(argv)] = ret.returncode, ret.stdout
+
+        # Half the clients talk to the socket, half go through wyag
+        # itself, which forwards to the daemon.
+        results = [ None ] * len(requests)
+        def client(i, argv):
+            if i % 2:
+                results[i] = self.ask(argv)
+            else:
+                ret = wyag(self.dir, *argv)
+                results[i] = ret.returncode, ret.stdout
+        threads = [ threading.Thread(target=client, args=(i, argv)) for i, (argv, _) in enumerate(requests) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for i, (argv, success) in enumerate(requests):
+            status, output = expected[tuple(argv)]
+            with self.subTest(argv=argv, client=i):
+                self.assertEqual(results[i][0], status)
+                # Errors are reported differently (no traceback).
+                if success:
+                    self.assertEqual(results[i][0], 0)
+                    self.assertTrue(output)
+                    self.assertEqual(results[i][1], output)
+
+        self.daemon.send_signal(signal.SIGTERM)
+        self.assertEqual(self.daemon.wait(timeout=10), 0)
+        self.assertFalse(os.path.exists(self.socket))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""status hashes each file whose stat data changed once, including when
+it writes the refreshed index.  Run with: python -m unittest discover tests"""
+
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import libwyag
+
+def git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True).stdout
+
+class StatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        git(self.dir, "init", "-q")
+        for i in range(4):
+            with open(os.path.join(self.dir, f"f{i}"), "w") as f:
+                f.write(f"{i}\n")
+        git(self.dir, "add", ".")
+
+        self.hashes = 0
+        worktree_hash = libwyag.worktree_hash
+        def counted(*args):
+            self.hashes += 1
+            return worktree_hash(*args)
+        libwyag.worktree_hash = counted
+        self.addCleanup(setattr, libwyag, "worktree_hash", worktree_hash)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_touched_files_hashed_once(self):
+        # Touched after the index was written, so the refreshed entries
+        # are racy when status writes the index back (but not anymore
+        # once it's written).
+        now = time.time()
+        os.utime(os.path.join(self.dir, ".git", "index"), (now - 100, now - 100))
+        for i in range(4):
+            os.utime(os.path.join(self.dir, f"f{i}"), (now - 50, now - 50))
+        repo = libwyag.repo_find(self.dir)
+        index = libwyag.index_read(repo)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            libwyag.cmd_status_index_worktree(repo, index)
+        self.assertNotIn("modified", out.getvalue())
+        self.assertEqual(self.hashes, 4)
+
+        # And the index written has the new stat data.
+        self.hashes = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            libwyag.cmd_status_index_worktree(repo, libwyag.index_read(repo))
+        self.assertEqual(self.hashes, 0)
+
+if __name__ == "__main__":
+    unittest.main()